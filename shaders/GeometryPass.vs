@@ -9,9 +9,12 @@ uniform mat4 blurModelViewProjMatrix;
 
 uniform vec2 textureScale;
 
+uniform bool instancing;
+
 layout (location = 0) in vec3 va_Vertex;
 layout (location = 1) in vec3 va_Normal;
 layout (location = 2) in vec2 va_Texcoord;
+layout (location = 4) in mat4 va_InstanceMatrix;
 
 out vec2 texCoord;
 out vec3 eyePosition;
@@ -22,15 +25,21 @@ out vec4 prevPosition;
 
 void main()
 {
+    mat4 instanceMatrix = instancing? va_InstanceMatrix : mat4(1.0);
+    vec4 vertex = instanceMatrix * vec4(va_Vertex, 1.0);
+    // Inverse transpose keeps normals correct under non-uniform instance scale
+    mat3 instanceNormalMatrix = instancing? transpose(inverse(mat3(va_InstanceMatrix))) : mat3(1.0);
+    vec4 normal = vec4(instanceNormalMatrix * va_Normal, 0.0);
+
     texCoord = va_Texcoord * textureScale;
-    eyeNormal = (normalMatrix * vec4(va_Normal, 0.0)).xyz;
-    vec4 pos = modelViewMatrix * vec4(va_Vertex, 1.0);
+    eyeNormal = (normalMatrix * normal).xyz;
+    vec4 pos = modelViewMatrix * vertex;
     eyePosition = pos.xyz;
 
     vec4 position = projectionMatrix * pos;
 
-    blurPosition = blurModelViewProjMatrix * vec4(va_Vertex, 1.0);
-    prevPosition = prevModelViewProjMatrix * vec4(va_Vertex, 1.0);
+    blurPosition = blurModelViewProjMatrix * vertex;
+    prevPosition = prevModelViewProjMatrix * vertex;
 
     gl_Position = position;
 }
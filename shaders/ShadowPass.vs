@@ -3,9 +3,13 @@
 uniform mat4 modelViewMatrix;
 uniform mat4 projectionMatrix;
 
+uniform bool instancing;
+
 layout (location = 0) in vec3 va_Vertex;
+layout (location = 4) in mat4 va_InstanceMatrix;
 
 void main()
 {
-    gl_Position = projectionMatrix * modelViewMatrix * vec4(va_Vertex, 1.0);
+    mat4 instanceMatrix = instancing? va_InstanceMatrix : mat4(1.0);
+    gl_Position = projectionMatrix * modelViewMatrix * instanceMatrix * vec4(va_Vertex, 1.0);
 }
@@ -3,6 +3,7 @@
 layout (location = 0) in vec3 va_Vertex;
 layout (location = 1) in vec3 va_Normal;
 layout (location = 2) in vec2 va_Texcoord;
+layout (location = 4) in mat4 va_InstanceMatrix;
 
 out vec3 eyePosition;
 out vec3 eyeNormal;
@@ -33,13 +34,20 @@ uniform mat4 blurModelViewProjMatrix;
 
 uniform vec2 textureScale;
 
+uniform bool instancing;
+
 void main()
 {
-    vec4 pos = modelViewMatrix * vec4(va_Vertex, 1.0);
+    mat4 instanceMatrix = instancing? va_InstanceMatrix : mat4(1.0);
+    vec4 vertex = instanceMatrix * vec4(va_Vertex, 1.0);
+    // Inverse transpose keeps normals correct under non-uniform instance scale
+    mat3 instanceNormalMatrix = instancing? transpose(inverse(mat3(va_InstanceMatrix))) : mat3(1.0);
+
+    vec4 pos = modelViewMatrix * vertex;
 
     eyePosition = pos.xyz;
     texCoord = va_Texcoord * textureScale;;
-    eyeNormal = (normalMatrix * vec4(va_Normal, 0.0)).xyz;
+    eyeNormal = (normalMatrix * vec4(instanceNormalMatrix * va_Normal, 0.0)).xyz;
 
     worldPosition = (invViewMatrix * pos).xyz;
     vec3 worldCamPos = (invViewMatrix[3]).xyz;
@@ -50,8 +58,8 @@ void main()
     shadowCoord2 = shadowMatrix2 * posShifted;
     shadowCoord3 = shadowMatrix3 * posShifted;
 
-    blurPosition = blurModelViewProjMatrix * vec4(va_Vertex, 1.0);
-    prevPosition = prevModelViewProjMatrix * vec4(va_Vertex, 1.0);
+    blurPosition = blurModelViewProjMatrix * vertex;
+    prevPosition = prevModelViewProjMatrix * vertex;
 
     gl_Position = projectionMatrix * pos;
 }
@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+#
+# Box archive library and command line tool.
+# Doesn't depend on Blender, so it can be used in build and patch pipelines.
+#
+# Usage:
+#   boxfile.py list <archive> [-l]
+#   boxfile.py cat <archive> <entry>
+#   boxfile.py extract <archive> [entries...] [-o <dir>]
+#   boxfile.py add <archive> <file> [--name <entry>] [--store]
+#   boxfile.py remove <archive> <entry>
+#   boxfile.py verify <archive>
+#   boxfile.py create <archive> <dir> [--store] [--no-hash-table]
+#   boxfile.py compact <archive> [<output>]
+#
+# See asset-format-spec.md for the format description.
+
+import os
+import sys
+import mmap
+import struct
+import zlib
+import argparse
+
+BOX_LEGACY_MAGIC = b'BOXF'
+BOX_MAGIC = b'BOXV'
+BOX_VERSION = 3
+BOX_HEADER_SIZE = 32
+BOX_V2_HEADER_SIZE = 24
+BOX_LEGACY_HEADER_SIZE = 12
+BOX_ENTRY_COMPRESSED = 1
+
+# Already compressed formats that zlib can't shrink further
+uncompressibleExtensions = ['.png', '.jpg', '.jpeg']
+
+class BoxError(Exception):
+    pass
+
+def boxHash(filename):
+    # 64-bit FNV-1a, 0 is reserved for empty slots
+    h = 14695981039346656037
+    for c in filename.encode('ascii'):
+        h = h ^ c
+        h = (h * 1099511628211) & 0xFFFFFFFFFFFFFFFF
+    if h == 0:
+        h = 1
+    return h
+
+def shouldCompress(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    return not ext in uncompressibleExtensions
+
+def packEntryData(filename, data, compress = None):
+    # Returns (stored data, flags)
+    if compress is None:
+        compress = shouldCompress(filename)
+    if compress:
+        compressedData = zlib.compress(data, 9)
+        if len(compressedData) < len(data):
+            return compressedData, BOX_ENTRY_COMPRESSED
+    return data, 0
+
+def packIndexEntry(entry):
+    filenameData = entry.name.encode('ascii')
+    return struct.pack('<I', len(filenameData)) + filenameData + struct.pack('<QQQI', entry.offset, entry.size, entry.uncompressedSize, entry.flags)
+
+def packHashTable(entryRecords):
+    # Open addressing with linear probing, load factor is at most 0.5
+    numSlots = 2
+    while numSlots < len(entryRecords) * 2:
+        numSlots = numSlots * 2
+    slots = [(0, 0)] * numSlots
+    for filename, recordOffset in entryRecords:
+        h = boxHash(filename)
+        slot = h & (numSlots - 1)
+        while slots[slot][0] != 0:
+            slot = (slot + 1) & (numSlots - 1)
+        slots[slot] = (h, recordOffset)
+    data = bytearray(struct.pack('<Q', numSlots))
+    for h, recordOffset in slots:
+        data += struct.pack('<QQ', h, recordOffset)
+    return data
+
+def packIndex(entries, indexOffset, useHashTable = True):
+    # Returns index and hash table data and the hash table offset
+    data = bytearray()
+    entryRecords = []
+    for entry in entries:
+        entryRecords.append((entry.name, indexOffset + len(data)))
+        data += packIndexEntry(entry)
+    hashTableOffset = 0
+    if useHashTable:
+        hashTableOffset = indexOffset + len(data)
+        data += packHashTable(entryRecords)
+    return data, hashTableOffset
+
+def headerSize(version):
+    if version == 1:
+        return BOX_LEGACY_HEADER_SIZE
+    elif version == 2:
+        return BOX_V2_HEADER_SIZE
+    return BOX_HEADER_SIZE
+
+def packHeader(numEntries, indexOffset, hashTableOffset, version = BOX_VERSION):
+    # Version 2 header has no hash table offset
+    if version == 2:
+        return BOX_MAGIC + struct.pack('<IQQ', version, numEntries, indexOffset)
+    return BOX_MAGIC + struct.pack('<IQQQ', version, numEntries, indexOffset, hashTableOffset)
+
+class BoxEntry:
+    def __init__(self, name, offset, size, uncompressedSize, flags):
+        self.name = name
+        self.offset = offset
+        self.size = size
+        self.uncompressedSize = uncompressedSize
+        self.flags = flags
+
+    def isCompressed(self):
+        return (self.flags & BOX_ENTRY_COMPRESSED) != 0
+
+class BoxFile:
+    '''
+    Random access to a Box archive through mmap.
+    Changes made by write and remove are applied in place by commit:
+    new data is written at the end of the file, followed by a new index.
+    Existing entries are never moved, so updating a large archive
+    costs only the size of the new data and the index.
+    '''
+
+    def __init__(self, filepath, writable = False):
+        self.filepath = filepath
+        self.writable = writable
+        self.file = open(filepath, 'r+b' if writable else 'rb')
+        self.map = None
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        self.fileSize = os.fstat(self.file.fileno()).st_size
+        if self.fileSize < BOX_LEGACY_HEADER_SIZE:
+            raise BoxError('%s: file is too small to be a Box archive' % self.filepath)
+        self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        magic = self.map[0:4]
+        if magic == BOX_LEGACY_MAGIC:
+            self.version = 1
+            numEntries, = struct.unpack_from('<Q', self.map, 4)
+            self.indexOffset = BOX_LEGACY_HEADER_SIZE
+            self.hashTableOffset = 0
+        elif magic == BOX_MAGIC:
+            self.version, numEntries, self.indexOffset = struct.unpack_from('<IQQ', self.map, 4)
+            self.hashTableOffset = 0
+            if self.version >= 3:
+                self.hashTableOffset, = struct.unpack_from('<Q', self.map, 24)
+        else:
+            raise BoxError('%s: not a Box archive' % self.filepath)
+
+        self.entries = []
+        self.entryMap = {}
+        pos = self.indexOffset
+        for i in range(numEntries):
+            entry, pos = self.readIndexEntry(pos)
+            self.entries.append(entry)
+            self.entryMap[entry.name] = entry
+        self.indexEnd = pos
+
+    def readIndexEntry(self, pos):
+        if pos + 4 > self.fileSize:
+            raise BoxError('%s: index is truncated' % self.filepath)
+        filenameSize, = struct.unpack_from('<I', self.map, pos)
+        pos += 4
+        name = self.map[pos:pos + filenameSize].decode('ascii')
+        pos += filenameSize
+        if self.version == 1:
+            offset, size = struct.unpack_from('<QQ', self.map, pos)
+            pos += 16
+            return BoxEntry(name, offset, size, size, 0), pos
+        else:
+            offset, size, uncompressedSize, flags = struct.unpack_from('<QQQI', self.map, pos)
+            pos += 28
+            return BoxEntry(name, offset, size, uncompressedSize, flags), pos
+
+    def close(self):
+        if self.dirty:
+            self.commit()
+        if self.map:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is not None:
+            self.dirty = False
+        self.close()
+
+    def names(self):
+        return [entry.name for entry in self.entries]
+
+    def entry(self, name):
+        try:
+            return self.entryMap[name]
+        except KeyError:
+            raise BoxError('%s: no entry "%s"' % (self.filepath, name))
+
+    def readStored(self, name):
+        # Returns entry data as it is stored in the archive
+        entry = self.entry(name)
+        if entry.offset >= self.fileSize:
+            return self.pending[entry.name]
+        return self.map[entry.offset:entry.offset + entry.size]
+
+    def read(self, name):
+        entry = self.entry(name)
+        data = self.readStored(name)
+        if entry.isCompressed():
+            data = zlib.decompress(data)
+        return data
+
+    def extract(self, outDir, names = None):
+        if names is None:
+            names = self.names()
+        for name in names:
+            outPath = os.path.join(outDir, *name.split('/'))
+            outSubdir = os.path.dirname(outPath)
+            if outSubdir and not os.path.exists(outSubdir):
+                os.makedirs(outSubdir)
+            f = open(outPath, 'wb')
+            f.write(self.read(name))
+            f.close()
+
+    def write(self, name, data, compress = None):
+        # Adds a new entry or replaces an existing one
+        if not self.writable:
+            raise BoxError('%s: archive is opened read-only' % self.filepath)
+        if self.version < 2:
+            raise BoxError('%s: legacy archives can\'t be updated in place, use compact first' % self.filepath)
+        if not hasattr(self, 'pending'):
+            self.pending = {}
+        storedData, flags = packEntryData(name, data, compress)
+        # Pending entries get offsets past the end of the file until commit
+        entry = BoxEntry(name, self.fileSize + sum(len(d) for d in self.pending.values()), len(storedData), len(data), flags)
+        if name in self.entryMap:
+            oldEntry = self.entryMap[name]
+            self.entries[self.entries.index(oldEntry)] = entry
+            self.pending.pop(name, None)
+        else:
+            self.entries.append(entry)
+        self.entryMap[name] = entry
+        self.pending[name] = storedData
+        self.dirty = True
+
+    def remove(self, name):
+        if not self.writable:
+            raise BoxError('%s: archive is opened read-only' % self.filepath)
+        if self.version < 2:
+            raise BoxError('%s: legacy archives can\'t be updated in place, use compact first' % self.filepath)
+        entry = self.entry(name)
+        self.entries.remove(entry)
+        del self.entryMap[name]
+        if hasattr(self, 'pending'):
+            self.pending.pop(name, None)
+        self.dirty = True
+
+    def commit(self):
+        '''
+        Writes pending data and a new index at the end of the file,
+        then switches the header to the new index. The old index stays valid
+        until the header is rewritten, so an interrupted commit doesn't
+        damage the archive. The header keeps the version of the archive:
+        version 2 archives are updated without a hash table.
+        The space taken by old indices and replaced entries is reclaimed by compact.
+        '''
+        if not self.dirty:
+            return
+        pending = getattr(self, 'pending', {})
+        self.map.close()
+        self.map = None
+
+        f = self.file
+        f.seek(self.fileSize)
+        offset = self.fileSize
+        for entry in self.entries:
+            if entry.name in pending and entry.offset >= self.fileSize:
+                data = pending[entry.name]
+                entry.offset = offset
+                f.write(data)
+                offset += len(data)
+
+        indexOffset = offset
+        indexData, hashTableOffset = packIndex(self.entries, indexOffset, self.hashTableOffset != 0)
+        f.write(indexData)
+        f.flush()
+        os.fsync(f.fileno())
+
+        f.seek(0)
+        f.write(packHeader(len(self.entries), indexOffset, hashTableOffset, self.version))
+        f.flush()
+
+        self.pending = {}
+        self.dirty = False
+        self.load()
+
+    def verify(self):
+        # Returns a list of problems, an empty list means the archive is valid
+        problems = []
+        dataStart = headerSize(self.version)
+        if self.indexOffset < dataStart or self.indexEnd > self.fileSize:
+            problems.append('index [%d, %d) is out of file bounds' % (self.indexOffset, self.indexEnd))
+
+        regions = []
+        for entry in self.entries:
+            end = entry.offset + entry.size
+            if entry.offset < dataStart or end > self.fileSize:
+                problems.append('%s: data [%d, %d) is out of file bounds' % (entry.name, entry.offset, end))
+                continue
+            if entry.offset < self.indexEnd and end > self.indexOffset:
+                problems.append('%s: data overlaps the index' % entry.name)
+            regions.append((entry.offset, end, entry.name))
+            if entry.isCompressed():
+                try:
+                    size = len(zlib.decompress(self.map[entry.offset:end]))
+                    if size != entry.uncompressedSize:
+                        problems.append('%s: inflates to %d bytes instead of %d' % (entry.name, size, entry.uncompressedSize))
+                except zlib.error as e:
+                    problems.append('%s: corrupted compressed data (%s)' % (entry.name, e))
+            elif entry.size != entry.uncompressedSize:
+                problems.append('%s: stored size %d differs from uncompressed size %d' % (entry.name, entry.size, entry.uncompressedSize))
+
+        regions.sort()
+        for i in range(1, len(regions)):
+            if regions[i][0] < regions[i - 1][1]:
+                problems.append('%s: data overlaps %s' % (regions[i][2], regions[i - 1][2]))
+
+        if len(self.entryMap) != len(self.entries):
+            problems.append('index contains duplicate filenames')
+
+        if self.hashTableOffset:
+            problems += self.verifyHashTable()
+
+        return problems
+
+    def verifyHashTable(self):
+        problems = []
+        if self.hashTableOffset + 8 > self.fileSize:
+            return ['hash table is out of file bounds']
+        numSlots, = struct.unpack_from('<Q', self.map, self.hashTableOffset)
+        if numSlots == 0 or numSlots & (numSlots - 1):
+            return ['hash table size %d is not a power of two' % numSlots]
+        if self.hashTableOffset + 8 + numSlots * 16 > self.fileSize:
+            return ['hash table is out of file bounds']
+
+        def slotAt(i):
+            return struct.unpack_from('<QQ', self.map, self.hashTableOffset + 8 + i * 16)
+
+        numUsed = 0
+        for i in range(numSlots):
+            h, recordOffset = slotAt(i)
+            if h == 0:
+                continue
+            numUsed += 1
+            if recordOffset < self.indexOffset or recordOffset >= self.indexEnd:
+                problems.append('hash slot %d points outside of the index' % i)
+
+        for entry in self.entries:
+            h = boxHash(entry.name)
+            slot = h & (numSlots - 1)
+            found = False
+            for probe in range(numSlots):
+                slotHash, recordOffset = slotAt(slot)
+                if slotHash == 0:
+                    break
+                if slotHash == h and self.indexOffset <= recordOffset < self.indexEnd:
+                    recordEntry, pos = self.readIndexEntry(recordOffset)
+                    if recordEntry.name == entry.name:
+                        found = recordEntry.offset == entry.offset and recordEntry.size == entry.size
+                        break
+                slot = (slot + 1) & (numSlots - 1)
+            if not found:
+                problems.append('%s: not reachable through the hash table' % entry.name)
+
+        if numUsed != len(self.entries):
+            problems.append('hash table has %d entries, index has %d' % (numUsed, len(self.entries)))
+        return problems
+
+def saveBox(filepath, entries, useHashTable = True):
+    '''
+    Writes a new archive from (name, stored data, uncompressed size, flags) tuples,
+    keeping the given order: header, data, index, hash table.
+    '''
+    f = open(filepath, 'wb')
+    f.write(bytearray(BOX_HEADER_SIZE))
+    boxEntries = []
+    offset = BOX_HEADER_SIZE
+    for name, storedData, uncompressedSize, flags in entries:
+        f.write(storedData)
+        boxEntries.append(BoxEntry(name, offset, len(storedData), uncompressedSize, flags))
+        offset += len(storedData)
+    indexData, hashTableOffset = packIndex(boxEntries, offset, useHashTable)
+    f.write(indexData)
+    f.seek(0)
+    f.write(packHeader(len(boxEntries), offset, hashTableOffset))
+    f.close()
+
+def createBox(filepath, rootDir, useCompression = True, useHashTable = True):
+    entries = []
+    for dirPath, dirNames, fileNames in os.walk(rootDir):
+        dirNames.sort()
+        for fileName in sorted(fileNames):
+            absPath = os.path.join(dirPath, fileName)
+            name = os.path.relpath(absPath, rootDir).replace(os.sep, '/')
+            f = open(absPath, 'rb')
+            data = f.read()
+            f.close()
+            storedData, flags = packEntryData(name, data, None if useCompression else False)
+            entries.append((name, storedData, len(data), flags))
+    saveBox(filepath, entries, useHashTable)
+
+def compactBox(filepath, outFilepath = None):
+    # Rewrites an archive without dead space, upgrading legacy archives
+    box = BoxFile(filepath)
+    entries = [(e.name, box.readStored(e.name), e.uncompressedSize, e.flags) for e in box.entries]
+    useHashTable = box.hashTableOffset != 0 or box.version < 3
+    box.close()
+    if outFilepath is None:
+        tmpFilepath = filepath + '.tmp'
+        saveBox(tmpFilepath, entries, useHashTable)
+        os.replace(tmpFilepath, filepath)
+    else:
+        saveBox(outFilepath, entries, useHashTable)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Inspect and update Box archives (*.asset)')
+    commands = parser.add_subparsers(dest = 'command')
+    commands.required = True
+
+    p = commands.add_parser('list', help = 'list entries')
+    p.add_argument('archive')
+    p.add_argument('-l', '--long', action = 'store_true', help = 'show offsets and sizes')
+
+    p = commands.add_parser('cat', help = 'write an entry to stdout')
+    p.add_argument('archive')
+    p.add_argument('entry')
+
+    p = commands.add_parser('extract', help = 'extract entries')
+    p.add_argument('archive')
+    p.add_argument('entries', nargs = '*')
+    p.add_argument('-o', '--output', default = '.')
+
+    p = commands.add_parser('add', help = 'add or replace an entry in place')
+    p.add_argument('archive')
+    p.add_argument('file')
+    p.add_argument('--name', help = 'entry name (default: file name)')
+    p.add_argument('--store', action = 'store_true', help = 'don\'t compress')
+
+    p = commands.add_parser('remove', help = 'remove an entry in place')
+    p.add_argument('archive')
+    p.add_argument('entry')
+
+    p = commands.add_parser('verify', help = 'check offsets, sizes and hash table')
+    p.add_argument('archive')
+
+    p = commands.add_parser('create', help = 'pack a directory')
+    p.add_argument('archive')
+    p.add_argument('dir')
+    p.add_argument('--store', action = 'store_true', help = 'don\'t compress')
+    p.add_argument('--no-hash-table', action = 'store_true')
+
+    p = commands.add_parser('compact', help = 'rewrite an archive without dead space')
+    p.add_argument('archive')
+    p.add_argument('output', nargs = '?')
+
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'list':
+            with BoxFile(args.archive) as box:
+                for entry in box.entries:
+                    if args.long:
+                        print('%12d %12d %12d %s %s' % (entry.offset, entry.size, entry.uncompressedSize, 'z' if entry.isCompressed() else '-', entry.name))
+                    else:
+                        print(entry.name)
+        elif args.command == 'cat':
+            with BoxFile(args.archive) as box:
+                sys.stdout.buffer.write(box.read(args.entry))
+        elif args.command == 'extract':
+            with BoxFile(args.archive) as box:
+                box.extract(args.output, args.entries or None)
+        elif args.command == 'add':
+            f = open(args.file, 'rb')
+            data = f.read()
+            f.close()
+            name = args.name or os.path.basename(args.file)
+            with BoxFile(args.archive, writable = True) as box:
+                box.write(name, data, False if args.store else None)
+        elif args.command == 'remove':
+            with BoxFile(args.archive, writable = True) as box:
+                box.remove(args.entry)
+        elif args.command == 'verify':
+            with BoxFile(args.archive) as box:
+                problems = box.verify()
+            for problem in problems:
+                print(problem)
+            if problems:
+                return 1
+            print('%s: OK' % args.archive)
+        elif args.command == 'create':
+            createBox(args.archive, args.dir, not args.store, not args.no_hash_table)
+        elif args.command == 'compact':
+            compactBox(args.archive, args.output)
+    except BoxError as e:
+        print(e, file = sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
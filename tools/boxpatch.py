@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+#
+# Entry-level delta patches between two versions of a Box archive.
+#
+# Usage:
+#   boxpatch.py diff <old archive> <new archive> <patch>
+#   boxpatch.py apply <old archive> <patch> <output archive>
+#   boxpatch.py info <patch>
+#
+# A patch describes the new archive as a sequence of operations:
+# copy a range of bytes from the old archive, or insert literal bytes.
+# Entries whose stored data didn't change are copied from the old archive,
+# everything else (new and changed entries, header, index, hash table)
+# is shipped in the patch. Applying a patch to the old archive reproduces
+# the new archive byte for byte, which is checked with SHA-256 digests.
+#
+# Patch layout (little-endian):
+#   char[4] magic = "BOXP"
+#   uint    version = 1
+#   byte[32] old archive SHA-256
+#   byte[32] new archive SHA-256
+#   ulong   new archive size
+#   ulong   numOps
+#   ulong   literal data size (compressed)
+#   op[numOps]:
+#       ubyte type         // 0 = copy, 1 = literal
+#       ulong offset       // copy: offset in the old archive, literal: offset in literal data
+#       ulong size
+#   byte[] literal data    // zlib stream
+
+import os
+import sys
+import struct
+import zlib
+import hashlib
+import argparse
+
+from boxfile import BoxFile, BoxError
+
+BOX_PATCH_MAGIC = b'BOXP'
+BOX_PATCH_VERSION = 1
+
+OP_COPY = 0
+OP_LITERAL = 1
+
+def readFile(filepath):
+    f = open(filepath, 'rb')
+    data = f.read()
+    f.close()
+    return data
+
+def diffBox(oldFilepath, newFilepath):
+    '''
+    Returns (ops, literal data, stats) that turn the old archive into the new one.
+    '''
+    oldData = readFile(oldFilepath)
+    newData = readFile(newFilepath)
+
+    # Stored data of old entries by content hash
+    oldBlobs = {}
+    oldNames = {}
+    with BoxFile(oldFilepath) as oldBox:
+        for entry in oldBox.entries:
+            blob = oldData[entry.offset:entry.offset + entry.size]
+            oldBlobs.setdefault(hashlib.sha256(blob).digest(), entry.offset)
+            oldNames[entry.name] = hashlib.sha256(blob).digest()
+
+    with BoxFile(newFilepath) as newBox:
+        newEntries = sorted(newBox.entries, key = lambda e: e.offset)
+
+    ops = []
+    literal = bytearray()
+    stats = {'unchanged': 0, 'changed': 0, 'added': 0, 'removed': 0}
+
+    def addCopy(offset, size):
+        if size == 0:
+            return
+        if ops and ops[-1][0] == OP_COPY and ops[-1][1] + ops[-1][2] == offset:
+            ops[-1] = (OP_COPY, ops[-1][1], ops[-1][2] + size)
+        else:
+            ops.append((OP_COPY, offset, size))
+
+    def addLiteral(data):
+        if len(data) == 0:
+            return
+        if ops and ops[-1][0] == OP_LITERAL:
+            ops[-1] = (OP_LITERAL, ops[-1][1], ops[-1][2] + len(data))
+        else:
+            ops.append((OP_LITERAL, len(literal), len(data)))
+        literal.extend(data)
+
+    pos = 0
+    for entry in newEntries:
+        if entry.offset < pos:
+            raise BoxError('%s: overlapping entries, run boxfile.py verify' % newFilepath)
+        # Header, old indices and other gaps between entries
+        addLiteral(newData[pos:entry.offset])
+        blob = newData[entry.offset:entry.offset + entry.size]
+        digest = hashlib.sha256(blob).digest()
+        if digest in oldBlobs:
+            addCopy(oldBlobs[digest], entry.size)
+        else:
+            addLiteral(blob)
+        if not entry.name in oldNames:
+            stats['added'] += 1
+        elif oldNames[entry.name] == digest:
+            stats['unchanged'] += 1
+        else:
+            stats['changed'] += 1
+        pos = entry.offset + entry.size
+    # Index and hash table
+    addLiteral(newData[pos:])
+
+    newNames = set(e.name for e in newEntries)
+    stats['removed'] = len([name for name in oldNames if not name in newNames])
+
+    header = (hashlib.sha256(oldData).digest(), hashlib.sha256(newData).digest(), len(newData))
+    return header, ops, bytes(literal), stats
+
+def savePatch(filepath, header, ops, literal):
+    oldDigest, newDigest, newSize = header
+    compressedLiteral = zlib.compress(literal, 9)
+    f = open(filepath, 'wb')
+    f.write(BOX_PATCH_MAGIC)
+    f.write(struct.pack('<I', BOX_PATCH_VERSION))
+    f.write(oldDigest)
+    f.write(newDigest)
+    f.write(struct.pack('<QQQ', newSize, len(ops), len(compressedLiteral)))
+    for opType, offset, size in ops:
+        f.write(struct.pack('<BQQ', opType, offset, size))
+    f.write(compressedLiteral)
+    f.close()
+
+def loadPatch(filepath):
+    data = readFile(filepath)
+    if data[0:4] != BOX_PATCH_MAGIC:
+        raise BoxError('%s: not a Box patch' % filepath)
+    version, = struct.unpack_from('<I', data, 4)
+    if version != BOX_PATCH_VERSION:
+        raise BoxError('%s: unsupported patch version %d' % (filepath, version))
+    oldDigest = data[8:40]
+    newDigest = data[40:72]
+    newSize, numOps, literalSize = struct.unpack_from('<QQQ', data, 72)
+    pos = 96
+    ops = []
+    for i in range(numOps):
+        ops.append(struct.unpack_from('<BQQ', data, pos))
+        pos += 17
+    literal = zlib.decompress(data[pos:pos + literalSize])
+    return (oldDigest, newDigest, newSize), ops, literal
+
+def applyPatch(oldFilepath, patchFilepath, outFilepath):
+    (oldDigest, newDigest, newSize), ops, literal = loadPatch(patchFilepath)
+    oldData = readFile(oldFilepath)
+    if hashlib.sha256(oldData).digest() != oldDigest:
+        raise BoxError('%s: patch was made for a different version of the archive' % oldFilepath)
+
+    newData = bytearray()
+    for opType, offset, size in ops:
+        if opType == OP_COPY:
+            newData += oldData[offset:offset + size]
+        elif opType == OP_LITERAL:
+            newData += literal[offset:offset + size]
+        else:
+            raise BoxError('%s: unknown operation %d' % (patchFilepath, opType))
+
+    if len(newData) != newSize or hashlib.sha256(newData).digest() != newDigest:
+        raise BoxError('%s: patched archive doesn\'t match the expected checksum' % outFilepath)
+
+    # Write to a temporary file first, so that a failure doesn't leave
+    # a half-written archive, and in-place patching (outFilepath == oldFilepath) works
+    tmpFilepath = outFilepath + '.tmp'
+    f = open(tmpFilepath, 'wb')
+    f.write(newData)
+    f.close()
+    os.replace(tmpFilepath, outFilepath)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Make and apply delta patches between Box archives (*.asset)')
+    commands = parser.add_subparsers(dest = 'command')
+    commands.required = True
+
+    p = commands.add_parser('diff', help = 'make a patch from old to new archive')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('patch')
+
+    p = commands.add_parser('apply', help = 'apply a patch to an archive')
+    p.add_argument('old')
+    p.add_argument('patch')
+    p.add_argument('output')
+
+    p = commands.add_parser('info', help = 'show patch operations')
+    p.add_argument('patch')
+
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'diff':
+            header, ops, literal, stats = diffBox(args.old, args.new)
+            savePatch(args.patch, header, ops, literal)
+            print('%d unchanged, %d changed, %d added, %d removed entries' %
+                (stats['unchanged'], stats['changed'], stats['added'], stats['removed']))
+            print('patch size: %d bytes, new archive size: %d bytes' % (os.path.getsize(args.patch), header[2]))
+        elif args.command == 'apply':
+            applyPatch(args.old, args.patch, args.output)
+        elif args.command == 'info':
+            (oldDigest, newDigest, newSize), ops, literal = loadPatch(args.patch)
+            print('old: %s' % oldDigest.hex())
+            print('new: %s (%d bytes)' % (newDigest.hex(), newSize))
+            for opType, offset, size in ops:
+                print('%s %12d %12d' % ('copy   ' if opType == OP_COPY else 'literal', offset, size))
+    except BoxError as e:
+        print(e, file = sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
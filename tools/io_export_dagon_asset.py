@@ -13,8 +13,10 @@ bl_info = {
 import os
 import shutil
 import struct
+import zlib
+import hashlib
 from pathlib import Path
-from math import pi
+from math import pi, floor, sqrt, sin, cos
 import bpy
 import bpy_extras
 from bpy.props import StringProperty
@@ -30,12 +32,14 @@ def packVector3f(v):
 def packVector2f(v):
     return struct.pack('<ff', v[0], v[1])
 
-def saveMesh(scene, ob, absPath, localPath):
+def saveMesh(scene, ob, absPath, localPath, name = None):
     mw = ob.matrix_world.copy()    
     ob.matrix_world.identity()
     scene.update()
 
-    meshAbsPath = absPath + "/" + ob.data.name + ".obj"
+    if name is None:
+        name = ob.data.name
+    meshAbsPath = absPath + "/" + name + ".obj"
     
     bpy.ops.object.select_all(action='DESELECT')
 
@@ -57,11 +61,63 @@ def saveMesh(scene, ob, absPath, localPath):
     ob.matrix_world = mw.copy();
     scene.update()
 
+# Meshes with fewer triangles don't get simplified levels of detail
+LOD_MIN_TRIANGLES = 64
+
+def saveMeshLODs(scene, ob, absPath, localPath, lodLevels, lodRatio, lodScreenSize):
+    # Writes simplified copies of the mesh (<mesh>.lod<N>.obj) and the description
+    # of the chain (<mesh>.lod). Meshes are simplified with collapse decimation
+    # (quadric error edge collapse) of the Decimate modifier
+    meshName = ob.data.name
+    numTris = sum([len(p.vertices) - 2 for p in ob.data.polygons])
+    radius = max([v.co.length for v in ob.data.vertices] + [0.0])
+
+    levels = [(localPath + meshName + ".obj", lodScreenSize)]
+    for level in range(1, lodLevels + 1):
+        ratio = pow(lodRatio, level)
+        if numTris * ratio < LOD_MIN_TRIANGLES:
+            break
+        mod = ob.modifiers.new("DagonLOD", 'DECIMATE')
+        mod.decimate_type = 'COLLAPSE'
+        mod.ratio = ratio
+        mod.use_collapse_triangulate = True
+        # Keep UV seams and material borders, so that the LOD has no texture cracks
+        mod.delimit = {'SEAM', 'UV', 'MATERIAL'}
+        lodName = "%s.lod%d" % (meshName, level)
+        saveMesh(scene, ob, absPath, localPath, lodName)
+        ob.modifiers.remove(mod)
+        levels.append((localPath + lodName + ".obj", lodScreenSize * pow(0.5, level)))
+
+    if len(levels) < 2:
+        return []
+
+    f = open(absPath + "/" + meshName + ".lod", 'wb')
+    f.write(bytearray(('radius %s\n' % (radius)).encode('ascii')))
+    for (filename, screenSize) in levels:
+        f.write(bytearray(('%s %s\n' % (screenSize, filename)).encode('ascii')))
+    f.close()
+
+    return [filename for (filename, screenSize) in levels[1:]] + [localPath + meshName + ".lod"]
+
+def isStaticChain(ob):
+    # Static objects whose ancestors are all static never move,
+    # so they are exported with absolute transformation and without parent
+    while ob:
+        if not ob.dagonProps.dagonStatic:
+            return False
+        ob = ob.parent
+    return True
+
 def saveMeshEntity(scene, ob, absPath, localPath):
     entityAbsPath = absPath + "/" + ob.name + ".entity"
 
+    static = isStaticChain(ob)
+
     global_matrix = bpy_extras.io_utils.axis_conversion(to_forward="-Z", to_up="Y").to_4x4()
-    absTrans = global_matrix * ob.matrix_local * global_matrix.transposed()
+    if static:
+        absTrans = global_matrix * ob.matrix_world * global_matrix.transposed()
+    else:
+        absTrans = global_matrix * ob.matrix_local * global_matrix.transposed()
 
     objPosition = absTrans.to_translation()
     objRotation = absTrans.to_quaternion()
@@ -73,7 +129,7 @@ def saveMeshEntity(scene, ob, absPath, localPath):
     
     props = ob.dagonProps
     
-    if ob.parent:
+    if ob.parent and not static:
         parentFilename = localPath + ob.parent.name + ".entity"
         parentStr = 'parent: \"%s\";\n' % (parentFilename)
         f.write(bytearray(parentStr.encode('ascii')))
@@ -109,11 +165,16 @@ def saveMeshEntity(scene, ob, absPath, localPath):
     layer = 'layer: %s;\n' % (props.dagonLayer)
     f.write(bytearray(layer.encode('ascii')))
 
+    staticStr = 'static: %s;\n' % (int(static))
+    f.write(bytearray(staticStr.encode('ascii')))
+
     f.close()
     
 def saveEmptyEntity(scene, ob, absPath, localPath):
     entityAbsPath = absPath + "/" + ob.name + ".entity"
 
+    static = isStaticChain(ob)
+
     global_matrix = bpy_extras.io_utils.axis_conversion(to_forward="-Z", to_up="Y").to_4x4()
     absTrans = global_matrix * ob.matrix_world * global_matrix.transposed()
 
@@ -127,7 +188,7 @@ def saveEmptyEntity(scene, ob, absPath, localPath):
     
     props = ob.dagonProps
     
-    if ob.parent:
+    if ob.parent and not static:
         parentFilename = localPath + ob.parent.name + ".entity"
         parentStr = 'parent: \"%s\";\n' % (parentFilename)
         f.write(bytearray(parentStr.encode('ascii')))
@@ -154,6 +215,9 @@ def saveEmptyEntity(scene, ob, absPath, localPath):
     layer = 'layer: %s;\n' % (props.dagonLayer)
     f.write(bytearray(layer.encode('ascii')))
 
+    staticStr = 'static: %s;\n' % (int(static))
+    f.write(bytearray(staticStr.encode('ascii')))
+
     f.close()
     
 def copyFile(fileSrc, destDir):
@@ -321,6 +385,845 @@ def saveMaterial(scene, mat, absPath, localPath):
     
     f.close()
     
+# Binary scene table (see asset-format-spec.md)
+SCENE_TABLE_VERSION = 1
+SCENE_NONE = -1
+
+SCENE_MATERIAL_SHADELESS = 1
+SCENE_MATERIAL_CULLING = 2
+SCENE_MATERIAL_COLOR_WRITE = 4
+SCENE_MATERIAL_DEPTH_WRITE = 8
+SCENE_MATERIAL_USE_SHADOWS = 16
+SCENE_MATERIAL_USE_FOG = 32
+
+SCENE_ENTITY_VISIBLE = 1
+SCENE_ENTITY_CAST_SHADOW = 2
+SCENE_ENTITY_USE_MOTION_BLUR = 4
+SCENE_ENTITY_SOLID = 8
+SCENE_ENTITY_STATIC = 16
+
+class SceneStrings:
+    def __init__(self):
+        self.strings = []
+        self.indices = {}
+
+    def index(self, s):
+        if not s in self.indices:
+            self.indices[s] = len(self.strings)
+            self.strings.append(s)
+        return self.indices[s]
+
+def textureAbsPath(imageName):
+    imgAbsPath = bpy.path.abspath(imageName)
+    if imageName in bpy.data.images:
+        imgAbsPath = bpy.path.abspath(bpy.data.images[imageName].filepath)
+    return imgAbsPath
+
+def exportTexture(imageName, absPath, localPath):
+    # Copies the image to the package directory, returns its filename in the package
+    imgAbsPath = textureAbsPath(imageName)
+    copyFile(imgAbsPath, absPath)
+    return localPath + os.path.basename(imgAbsPath)
+
+def packSceneMaterial(mat, strings, absPath, localPath):
+    props = mat.dagonProps
+
+    def textureIndex(imageName):
+        if len(imageName):
+            return strings.index(exportTexture(imageName, absPath, localPath))
+        return SCENE_NONE
+
+    flags = 0
+    if props.dagonShadeless: flags |= SCENE_MATERIAL_SHADELESS
+    if props.dagonCulling: flags |= SCENE_MATERIAL_CULLING
+    if props.dagonColorWrite: flags |= SCENE_MATERIAL_COLOR_WRITE
+    if props.dagonDepthWrite: flags |= SCENE_MATERIAL_DEPTH_WRITE
+    if props.dagonReceiveShadows: flags |= SCENE_MATERIAL_USE_SHADOWS
+    if props.dagonFog: flags |= SCENE_MATERIAL_USE_FOG
+
+    parallaxMode = {
+        'ParallaxNone': 0,
+        'ParallaxSimple': 1,
+        'ParallaxOcclusionMapping': 2,
+    }[props.dagonParallaxMode]
+
+    shadowFilter = {
+        'ShadowFilterNone': 0,
+        'ShadowFilterPCF': 1
+    }[props.dagonShadowFilter]
+
+    blendingMode = {
+        'BlendingModeOpaque': 0,
+        'BlendingModeTransparent': 1,
+        'BlendingModeAdditive': 2
+    }[props.dagonBlendingMode]
+
+    data = struct.pack('<IIi', strings.index(mat.name), flags, textureIndex(props.dagonDiffuseTexture))
+    data += packVector3f(props.dagonDiffuse)
+    data += struct.pack('<if', textureIndex(props.dagonRoughnessTexture), props.dagonRoughness)
+    data += struct.pack('<if', textureIndex(props.dagonMetallicTexture), props.dagonMetallic)
+    data += struct.pack('<i', textureIndex(props.dagonEmissionTexture))
+    data += packVector3f(props.dagonEmission)
+    data += struct.pack('<f', props.dagonEnergy)
+    data += struct.pack('<ii', textureIndex(props.dagonNormalTexture), textureIndex(props.dagonHeightTexture))
+    data += struct.pack('<iff', parallaxMode, props.dagonParallaxScale, props.dagonParallaxBias)
+    data += struct.pack('<iif', shadowFilter, blendingMode, props.dagonTransparency)
+    return data
+
+def packSceneEntity(ob, parentIndex, materialIndices, strings, localPath):
+    # Same transformations as in saveMeshEntity and saveEmptyEntity
+    global_matrix = bpy_extras.io_utils.axis_conversion(to_forward="-Z", to_up="Y").to_4x4()
+    static = isStaticChain(ob)
+    if ob.type == 'MESH' and not static:
+        absTrans = global_matrix * ob.matrix_local * global_matrix.transposed()
+    else:
+        absTrans = global_matrix * ob.matrix_world * global_matrix.transposed()
+
+    props = ob.dagonProps
+
+    meshIndex = SCENE_NONE
+    materialIndex = SCENE_NONE
+    if ob.type == 'MESH':
+        meshIndex = strings.index(localPath + ob.data.name + ".obj")
+        if len(ob.data.materials) > 0 and ob.data.materials[0]:
+            materialIndex = materialIndices[ob.data.materials[0].name]
+
+    flags = 0
+    if props.dagonVisible: flags |= SCENE_ENTITY_VISIBLE
+    if props.dagonCastShadow: flags |= SCENE_ENTITY_CAST_SHADOW
+    if props.dagonUseMotionBlur: flags |= SCENE_ENTITY_USE_MOTION_BLUR
+    if props.dagonSolid: flags |= SCENE_ENTITY_SOLID
+    if static: flags |= SCENE_ENTITY_STATIC
+
+    rot = absTrans.to_quaternion()
+    data = struct.pack('<IiiiIi', strings.index(ob.name), parentIndex, meshIndex, materialIndex, flags, props.dagonLayer)
+    data += packVector3f(absTrans.to_translation())
+    data += packVector4f((rot.x, rot.y, rot.z, rot.w))
+    data += packVector3f(absTrans.to_scale())
+    return data
+
+def sortSceneObjects(objects):
+    # Parents must precede their children in the table
+    objectNames = set(ob.name for ob in objects)
+    result = []
+    def visit(ob):
+        result.append(ob)
+        for child in sorted(ob.children, key = lambda c: c.name):
+            if child.name in objectNames:
+                visit(child)
+    for ob in objects:
+        if ob.parent is None or not ob.parent.name in objectNames:
+            visit(ob)
+    return result
+
+def saveSceneTable(objects, materials, absPath, localPath):
+    strings = SceneStrings()
+
+    materialIndices = {}
+    materialData = bytearray()
+    for i, mat in enumerate(materials):
+        materialIndices[mat.name] = i
+        materialData += packSceneMaterial(mat, strings, absPath, localPath)
+
+    objects = sortSceneObjects(objects)
+    objectIndices = {}
+    entityData = bytearray()
+    for i, ob in enumerate(objects):
+        objectIndices[ob.name] = i
+        parentIndex = SCENE_NONE
+        if ob.parent and ob.parent.name in objectIndices and not isStaticChain(ob):
+            parentIndex = objectIndices[ob.parent.name]
+        entityData += packSceneEntity(ob, parentIndex, materialIndices, strings, localPath)
+
+    stringRecords = bytearray()
+    stringData = bytearray()
+    for s in strings.strings:
+        sdata = s.encode('ascii')
+        stringRecords += struct.pack('<II', len(stringData), len(sdata))
+        stringData += sdata
+
+    f = open(absPath + "/SCENE", 'wb')
+    f.write(b'DSCN')
+    f.write(struct.pack('<IIIII', SCENE_TABLE_VERSION, len(strings.strings), len(stringData), len(materials), len(objects)))
+    f.write(stringRecords)
+    f.write(stringData)
+    f.write(materialData)
+    f.write(entityData)
+    f.close()
+
+# Static batching (see asset-format-spec.md)
+
+class StaticBatchData:
+    def __init__(self, name, materials):
+        self.name = name
+        self.materials = materials
+
+class StaticBatch:
+    # Static objects merged into one mesh in world space.
+    # Has the same attributes as a mesh object, so it is exported
+    # as an entity in place of its source objects
+    def __init__(self, name, material, props, sources):
+        self.name = name
+        self.type = 'MESH'
+        self.parent = None
+        self.children = []
+        self.matrix_world = mathutils.Matrix.Identity(4)
+        self.matrix_local = mathutils.Matrix.Identity(4)
+        self.dagonProps = props
+        self.data = StaticBatchData(name, [material] if material else [])
+        self.sources = sources
+        bbMin, bbMax = worldBounds(sources)
+        self.bound_box = [(x, y, z) for x in (bbMin[0], bbMax[0]) for y in (bbMin[1], bbMax[1]) for z in (bbMin[2], bbMax[2])]
+
+class StaticBatchProps:
+    def __init__(self, visible, castShadow, solid, layer):
+        self.dagonVisible = visible
+        self.dagonCastShadow = castShadow
+        self.dagonUseMotionBlur = False
+        self.dagonSolid = solid
+        self.dagonLayer = layer
+        self.dagonStatic = True
+
+def worldBounds(obs):
+    # World space bounding box of mesh objects in Blender coordinates (Z-up)
+    bbMin = None
+    bbMax = None
+    for ob in obs:
+        for c in ob.bound_box:
+            p = ob.matrix_world * mathutils.Vector(c)
+            if bbMin is None:
+                bbMin = p.copy()
+                bbMax = p.copy()
+            else:
+                for i in range(3):
+                    bbMin[i] = min(bbMin[i], p[i])
+                    bbMax[i] = max(bbMax[i], p[i])
+    return bbMin, bbMax
+
+def makeStaticBatches(objects, cellSize):
+    # Groups static mesh objects (with static ancestors) without children by material, grid cell and entity properties.
+    # Returns the list of objects where the grouped objects are replaced with batches.
+    # Groups of a single object are not merged
+    groups = {}
+    result = []
+    for ob in objects:
+        props = ob.dagonProps
+        if ob.type == 'MESH' and isStaticChain(ob) and len(ob.children) == 0:
+            mat = None
+            if len(ob.data.materials) > 0:
+                mat = ob.data.materials[0]
+            bbMin, bbMax = worldBounds([ob])
+            center = (bbMin + bbMax) * 0.5
+            cell = (int(floor(center.x / cellSize)), int(floor(center.y / cellSize)))
+            key = (mat.name if mat else '', cell, props.dagonVisible, props.dagonCastShadow, props.dagonSolid, props.dagonLayer)
+            if not key in groups:
+                groups[key] = (mat, [])
+            groups[key][1].append(ob)
+        else:
+            result.append(ob)
+
+    for key in sorted(groups):
+        mat, sources = groups[key]
+        if len(sources) < 2:
+            result += sources
+            continue
+        matName, cell, visible, castShadow, solid, layer = key
+        name = 'Batch%d_%s_%d_%d' % (len(result), matName if mat else 'Default', cell[0], cell[1])
+        props = StaticBatchProps(visible, castShadow, solid, layer)
+        result.append(StaticBatch(name, mat, props, sources))
+
+    return sorted(result, key = lambda ob: ob.name)
+
+def saveStaticBatch(scene, batch, absPath, localPath):
+    # Writes the merged mesh (*.obj) in world space and triangle ranges of the source objects (*.ranges).
+    # Returns filenames of both files in the package
+    global_matrix = bpy_extras.io_utils.axis_conversion(to_forward="-Z", to_up="Y").to_4x4()
+
+    objLines = []
+    rangeLines = []
+    numVertices = 0
+    numLoops = 0
+    numTriangles = 0
+
+    for ob in batch.sources:
+        mesh = ob.to_mesh(scene, True, 'PREVIEW')
+        mesh.calc_normals_split()
+        matrix = global_matrix * ob.matrix_world
+        normalMatrix = matrix.to_3x3().inverted().transposed()
+        flip = matrix.determinant() < 0.0
+        uvLayer = mesh.uv_layers.active.data if mesh.uv_layers.active else None
+
+        firstTriangle = numTriangles
+        bbMin = None
+        bbMax = None
+
+        for v in mesh.vertices:
+            p = matrix * v.co
+            objLines.append('v %.6f %.6f %.6f\n' % (p.x, p.y, p.z))
+            if bbMin is None:
+                bbMin = p.copy()
+                bbMax = p.copy()
+            else:
+                for i in range(3):
+                    bbMin[i] = min(bbMin[i], p[i])
+                    bbMax[i] = max(bbMax[i], p[i])
+
+        for loop in mesh.loops:
+            n = (normalMatrix * loop.normal).normalized()
+            objLines.append('vn %.6f %.6f %.6f\n' % (n.x, n.y, n.z))
+            uv = uvLayer[loop.index].uv if uvLayer else (0.0, 0.0)
+            objLines.append('vt %.6f %.6f\n' % (uv[0], uv[1]))
+
+        for poly in mesh.polygons:
+            loops = list(poly.loop_indices)
+            for i in range(1, len(loops) - 1):
+                tri = [loops[0], loops[i], loops[i + 1]]
+                if flip:
+                    tri.reverse()
+                refs = ['%d/%d/%d' % (numVertices + mesh.loops[l].vertex_index + 1, numLoops + l + 1, numLoops + l + 1) for l in tri]
+                objLines.append('f %s\n' % ' '.join(refs))
+                numTriangles += 1
+
+        numVertices += len(mesh.vertices)
+        numLoops += len(mesh.loops)
+        bpy.data.meshes.remove(mesh)
+
+        if numTriangles > firstTriangle:
+            rangeLines.append('%d %d %.6f %.6f %.6f %.6f %.6f %.6f\n' % (firstTriangle, numTriangles - firstTriangle,
+                bbMin.x, bbMin.y, bbMin.z, bbMax.x, bbMax.y, bbMax.z))
+
+    f = open(absPath + "/" + batch.data.name + ".obj", 'wb')
+    f.write(bytearray(''.join(objLines).encode('ascii')))
+    f.close()
+
+    f = open(absPath + "/" + batch.data.name + ".ranges", 'wb')
+    f.write(bytearray(''.join(rangeLines).encode('ascii')))
+    f.close()
+
+    return [localPath + batch.data.name + ".obj", localPath + batch.data.name + ".ranges"]
+
+# Collision BVH (see asset-format-spec.md)
+COLLISION_BVH_VERSION = 1
+COLLISION_BVH_MAX_DEPTH = 48
+COLLISION_BVH_MAX_LEAF_SIZE = 16
+
+def worldTriangles(scene, ob):
+    # Triangles of a mesh object in world space, in Dagon coordinates
+    global_matrix = bpy_extras.io_utils.axis_conversion(to_forward="-Z", to_up="Y").to_4x4()
+    mesh = ob.to_mesh(scene, True, 'PREVIEW')
+    matrix = global_matrix * ob.matrix_world
+    flip = matrix.determinant() < 0.0
+    verts = [tuple(matrix * v.co) for v in mesh.vertices]
+    tris = []
+    for poly in mesh.polygons:
+        vs = list(poly.vertices)
+        for i in range(1, len(vs) - 1):
+            tri = [verts[vs[0]], verts[vs[i]], verts[vs[i + 1]]]
+            if flip:
+                tri.reverse()
+            tris.append(tuple(tri))
+    bpy.data.meshes.remove(mesh)
+    return tris
+
+def surfaceArea(bmin, bmax):
+    dx = bmax[0] - bmin[0]
+    dy = bmax[1] - bmin[1]
+    dz = bmax[2] - bmin[2]
+    return 2.0 * (dx * dy + dx * dz + dy * dz)
+
+def findSAHSplit(indices, triMin, triMax, centroids, nodeArea, numBins):
+    # Binned SAH split by triangle centroids.
+    # Returns (left, right) index lists or None if a leaf is cheaper
+    cmin = [min(centroids[i][a] for i in indices) for a in range(3)]
+    cmax = [max(centroids[i][a] for i in indices) for a in range(3)]
+
+    best = None
+    bestCost = float(len(indices))
+    for axis in range(3):
+        extent = cmax[axis] - cmin[axis]
+        if extent <= 0.0:
+            continue
+
+        def binOf(i, axis = axis, extent = extent):
+            return min(int((centroids[i][axis] - cmin[axis]) / extent * numBins), numBins - 1)
+
+        counts = [0] * numBins
+        binMin = [None] * numBins
+        binMax = [None] * numBins
+        for i in indices:
+            b = binOf(i)
+            counts[b] += 1
+            if binMin[b] is None:
+                binMin[b] = list(triMin[i])
+                binMax[b] = list(triMax[i])
+            else:
+                for a in range(3):
+                    binMin[b][a] = min(binMin[b][a], triMin[i][a])
+                    binMax[b][a] = max(binMax[b][a], triMax[i][a])
+
+        # Area and count of everything to the right of each split
+        rightArea = [0.0] * numBins
+        rightCount = [0] * numBins
+        rmin = None
+        rmax = None
+        n = 0
+        for b in range(numBins - 1, 0, -1):
+            if counts[b]:
+                n += counts[b]
+                if rmin is None:
+                    rmin = list(binMin[b])
+                    rmax = list(binMax[b])
+                else:
+                    rmin = [min(rmin[a], binMin[b][a]) for a in range(3)]
+                    rmax = [max(rmax[a], binMax[b][a]) for a in range(3)]
+            rightCount[b] = n
+            rightArea[b] = surfaceArea(rmin, rmax) if rmin else 0.0
+
+        lmin = None
+        lmax = None
+        n = 0
+        for b in range(0, numBins - 1):
+            if counts[b]:
+                n += counts[b]
+                if lmin is None:
+                    lmin = list(binMin[b])
+                    lmax = list(binMax[b])
+                else:
+                    lmin = [min(lmin[a], binMin[b][a]) for a in range(3)]
+                    lmax = [max(lmax[a], binMax[b][a]) for a in range(3)]
+            if n == 0 or rightCount[b + 1] == 0:
+                continue
+            # Traversal step costs as much as 1/8 of a triangle test
+            cost = 0.125 + (surfaceArea(lmin, lmax) * n + rightArea[b + 1] * rightCount[b + 1]) / max(nodeArea, 1e-12)
+            if cost < bestCost:
+                bestCost = cost
+                best = (axis, b, binOf)
+
+    if best is None:
+        if len(indices) <= COLLISION_BVH_MAX_LEAF_SIZE:
+            return None
+        # Coincident centroids, split in halves
+        half = len(indices) // 2
+        return indices[:half], indices[half:]
+
+    axis, splitBin, binOf = best
+    left = [i for i in indices if binOf(i) <= splitBin]
+    right = [i for i in indices if binOf(i) > splitBin]
+    return left, right
+
+def triangleArea(t):
+    e1 = [t[1][a] - t[0][a] for a in range(3)]
+    e2 = [t[2][a] - t[0][a] for a in range(3)]
+    n = (e1[1] * e2[2] - e1[2] * e2[1], e1[2] * e2[0] - e1[0] * e2[2], e1[0] * e2[1] - e1[1] * e2[0])
+    return sqrt(n[0] * n[0] + n[1] * n[1] + n[2] * n[2]) * 0.5
+
+def buildCollisionBVH(tris, maxLeafSize = 4, numBins = 16):
+    # Returns (nodes, triangle order). Nodes are (min, max, first, count) tuples:
+    # a leaf refers to count triangles from first in the triangle order,
+    # an internal node (count = 0) to the children first and first + 1
+    triMin = [tuple(min(v[a] for v in t) for a in range(3)) for t in tris]
+    triMax = [tuple(max(v[a] for v in t) for a in range(3)) for t in tris]
+    centroids = [tuple((triMin[i][a] + triMax[i][a]) * 0.5 for a in range(3)) for i in range(len(tris))]
+
+    nodes = [None]
+    order = []
+    stack = [(0, list(range(len(tris))), 0)]
+    while stack:
+        nodeIndex, indices, depth = stack.pop()
+        bmin = tuple(min(triMin[i][a] for i in indices) for a in range(3))
+        bmax = tuple(max(triMax[i][a] for i in indices) for a in range(3))
+
+        split = None
+        if len(indices) > maxLeafSize and depth < COLLISION_BVH_MAX_DEPTH:
+            split = findSAHSplit(indices, triMin, triMax, centroids, surfaceArea(bmin, bmax), numBins)
+
+        if split is None:
+            nodes[nodeIndex] = (bmin, bmax, len(order), len(indices))
+            order += indices
+            continue
+
+        left, right = split
+        childIndex = len(nodes)
+        nodes += [None, None]
+        nodes[nodeIndex] = (bmin, bmax, childIndex, 0)
+        stack.append((childIndex + 1, right, depth + 1))
+        stack.append((childIndex, left, depth + 1))
+
+    return nodes, order
+
+def saveCollisionBVH(tris, absPath):
+    # Zero-area triangles have no normal, the engine skips them
+    tris = [t for t in tris if triangleArea(t) > 0.0]
+    nodes, order = buildCollisionBVH(tris)
+    f = open(absPath + "/COLLISION", 'wb')
+    f.write(b'DBVH')
+    f.write(struct.pack('<III', COLLISION_BVH_VERSION, len(nodes), len(order)))
+    for bmin, bmax, first, count in nodes:
+        f.write(struct.pack('<6fII', bmin[0], bmin[1], bmin[2], bmax[0], bmax[1], bmax[2], first, count))
+    for i in order:
+        for v in tris[i]:
+            f.write(struct.pack('<3f', v[0], v[1], v[2]))
+    f.close()
+
+# Convex hulls (see asset-format-spec.md)
+HULL_VERSION = 1
+HULL_MAX_PARTS = 64
+
+def looseParts(mesh):
+    # Groups of vertex indices connected by polygons
+    parent = list(range(len(mesh.vertices)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for poly in mesh.polygons:
+        vs = list(poly.vertices)
+        for v in vs[1:]:
+            a = find(vs[0])
+            b = find(v)
+            if a != b:
+                parent[b] = a
+    parts = {}
+    for poly in mesh.polygons:
+        for v in poly.vertices:
+            parts.setdefault(find(v), set()).add(v)
+    return [sorted(part) for _, part in sorted(parts.items())]
+
+def sphereDirections(num):
+    # Evenly distributed unit vectors (Fibonacci sphere)
+    dirs = []
+    golden = pi * (3.0 - sqrt(5.0))
+    for i in range(num):
+        y = 1.0 - 2.0 * (i + 0.5) / num
+        r = sqrt(max(0.0, 1.0 - y * y))
+        dirs.append((cos(golden * i) * r, y, sin(golden * i) * r))
+    return dirs
+
+def simplifyHullPoints(points, maxVertices):
+    # Keeps the extreme points in a set of sampled directions,
+    # which gives a hull inscribed into the original one
+    if len(points) <= maxVertices:
+        return points
+    chosen = []
+    for d in sphereDirections(maxVertices * 4):
+        best = max(range(len(points)), key = lambda i: points[i][0] * d[0] + points[i][1] * d[1] + points[i][2] * d[2])
+        if not best in chosen:
+            chosen.append(best)
+        if len(chosen) == maxVertices:
+            break
+    return [points[i] for i in sorted(chosen)]
+
+def sub3(a, b):
+    return (a[0] - b[0], a[1] - b[1], a[2] - b[2])
+
+def cross3(a, b):
+    return (a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0])
+
+def dot3(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+def convexHull(points):
+    # Incremental 3D convex hull. Returns (vertices, triangles)
+    # with outward-facing triangles, or None for flat or degenerate input
+    n = len(points)
+    if n < 4:
+        return None
+    extent = max(max(p[a] for p in points) - min(p[a] for p in points) for a in range(3))
+    eps = max(extent, 1e-6) * 1e-6
+
+    # Initial tetrahedron
+    i0 = min(range(n), key = lambda i: points[i])
+    i1 = max(range(n), key = lambda i: dot3(sub3(points[i], points[i0]), sub3(points[i], points[i0])))
+    d01 = sub3(points[i1], points[i0])
+    i2 = max(range(n), key = lambda i: dot3(cross3(d01, sub3(points[i], points[i0])), cross3(d01, sub3(points[i], points[i0]))))
+    normal = cross3(d01, sub3(points[i2], points[i0]))
+    i3 = max(range(n), key = lambda i: abs(dot3(normal, sub3(points[i], points[i0]))))
+    if abs(dot3(normal, sub3(points[i3], points[i0]))) <= eps * dot3(normal, normal) ** 0.5:
+        return None
+
+    def outward(a, b, c, inside):
+        nrm = cross3(sub3(points[b], points[a]), sub3(points[c], points[a]))
+        if dot3(nrm, sub3(inside, points[a])) > 0.0:
+            return (a, c, b)
+        return (a, b, c)
+
+    tetra = [i0, i1, i2, i3]
+    center = tuple(sum(points[i][a] for i in tetra) * 0.25 for a in range(3))
+    faces = [outward(i0, i1, i2, center), outward(i0, i1, i3, center),
+             outward(i0, i2, i3, center), outward(i1, i2, i3, center)]
+
+    def distance(face, p):
+        a, b, c = face
+        nrm = cross3(sub3(points[b], points[a]), sub3(points[c], points[a]))
+        length = dot3(nrm, nrm) ** 0.5
+        if length == 0.0:
+            return 0.0
+        return dot3(nrm, sub3(p, points[a])) / length
+
+    for i in range(n):
+        if i in tetra:
+            continue
+        visible = [f for f in faces if distance(f, points[i]) > eps]
+        if not visible:
+            continue
+        visibleEdges = set()
+        for a, b, c in visible:
+            visibleEdges.update([(a, b), (b, c), (c, a)])
+        horizon = [(a, b) for (a, b) in visibleEdges if not (b, a) in visibleEdges]
+        faces = [f for f in faces if not f in visible]
+        faces += [(a, b, i) for (a, b) in horizon]
+
+    used = sorted(set(v for f in faces for v in f))
+    remap = dict((v, k) for k, v in enumerate(used))
+    return [points[v] for v in used], [(remap[a], remap[b], remap[c]) for a, b, c in faces]
+
+def objectHulls(scene, ob, maxVertices):
+    # Hulls of loose parts of a mesh in object space
+    # (with object scale applied, since physics bodies are not scaled)
+    conv = bpy_extras.io_utils.axis_conversion(to_forward="-Z", to_up="Y")
+    mesh = ob.to_mesh(scene, True, 'PREVIEW')
+    sx, sy, sz = ob.scale
+    points = [tuple(conv * mathutils.Vector((v.co.x * sx, v.co.y * sy, v.co.z * sz))) for v in mesh.vertices]
+    parts = looseParts(mesh)
+    bpy.data.meshes.remove(mesh)
+
+    if len(parts) > HULL_MAX_PARTS:
+        parts = [sorted(v for part in parts for v in part)]
+
+    hulls = []
+    for part in parts:
+        hull = convexHull(simplifyHullPoints([points[v] for v in part], maxVertices))
+        if hull is not None:
+            hulls.append(hull)
+    return hulls
+
+def saveHulls(hulls, absPath, localPath, name):
+    f = open(absPath + "/" + name + ".hull", 'wb')
+    f.write(b'DHUL')
+    f.write(struct.pack('<II', HULL_VERSION, len(hulls)))
+    for vertices, triangles in hulls:
+        f.write(struct.pack('<II', len(vertices), len(triangles)))
+        for v in vertices:
+            f.write(struct.pack('<3f', v[0], v[1], v[2]))
+        for t in triangles:
+            f.write(struct.pack('<3I', t[0], t[1], t[2]))
+    f.close()
+    return localPath + name + ".hull"
+
+# Instance sets (see asset-format-spec.md)
+INSTANCES_VERSION = 1
+
+class InstanceSet:
+    # Copies of one mesh with one material, given by world matrices (Blender coordinates)
+    def __init__(self, name, meshObject, material):
+        self.name = name
+        self.meshObject = meshObject
+        self.material = material
+        self.instances = [] # (matrix, castShadow)
+
+def objectMaterial(ob):
+    if len(ob.data.materials) > 0:
+        return ob.data.materials[0]
+    return None
+
+def makeInstanceSets(scene, objects, minInstances):
+    # Linked duplicates (static mesh objects that share a mesh and a material)
+    # and dupli/particle instances of meshes.
+    # Returns (instance sets, remaining objects)
+    groups = {}
+    for ob in objects:
+        if isinstance(ob, StaticBatch) or ob.type != 'MESH' or not isStaticChain(ob) or ob.parent or len(ob.children):
+            continue
+        props = ob.dagonProps
+        if props.dagonSolid or not props.dagonVisible or props.dagonLayer != 1:
+            continue
+        mat = objectMaterial(ob)
+        key = (ob.data.name, mat.name if mat else '')
+        groups.setdefault(key, []).append(ob)
+
+    sets = []
+    instanced = set()
+    for key in sorted(groups.keys()):
+        obs = groups[key]
+        if len(obs) < minInstances:
+            continue
+        iset = InstanceSet(obs[0].name, obs[0], objectMaterial(obs[0]))
+        for ob in obs:
+            iset.instances.append((ob.matrix_world.copy(), ob.dagonProps.dagonCastShadow))
+            instanced.add(ob.name)
+        sets.append(iset)
+
+    for ob in objects:
+        if isinstance(ob, StaticBatch) or not getattr(ob, 'is_duplicator', False):
+            continue
+        dupliSets = {}
+        ob.dupli_list_create(scene)
+        for d in ob.dupli_list:
+            src = d.object
+            if src.type != 'MESH':
+                continue
+            mat = objectMaterial(src)
+            key = (src.data.name, mat.name if mat else '')
+            if not key in dupliSets:
+                dupliSets[key] = InstanceSet(ob.name + "_" + src.name, src, mat)
+            dupliSets[key].instances.append((d.matrix.copy(), src.dagonProps.dagonCastShadow))
+        ob.dupli_list_clear()
+        for key in sorted(dupliSets.keys()):
+            sets.append(dupliSets[key])
+
+    return sets, [ob for ob in objects if not ob.name in instanced]
+
+def saveInstanceSet(iset, cellSize, absPath, localPath):
+    # Instances are sorted by grid cell, shadow casters first in each cell
+    global_matrix = bpy_extras.io_utils.axis_conversion(to_forward="-Z", to_up="Y").to_4x4()
+    cells = {}
+    for matrix, castShadow in iset.instances:
+        corners = [global_matrix * matrix * mathutils.Vector(c) for c in iset.meshObject.bound_box]
+        bbMin = [min(c[i] for c in corners) for i in range(3)]
+        bbMax = [max(c[i] for c in corners) for i in range(3)]
+        cell = (int(floor((bbMin[0] + bbMax[0]) * 0.5 / cellSize)), int(floor((bbMin[2] + bbMax[2]) * 0.5 / cellSize)))
+        dagonMatrix = global_matrix * matrix * global_matrix.transposed()
+        cells.setdefault(cell, []).append((not castShadow, dagonMatrix, bbMin, bbMax))
+
+    cellData = bytearray()
+    instanceData = bytearray()
+    numInstances = 0
+    for cell in sorted(cells.keys()):
+        instances = sorted(cells[cell], key = lambda inst: inst[0])
+        numCasters = len([inst for inst in instances if not inst[0]])
+        bbMin = [min(inst[2][i] for inst in instances) for i in range(3)]
+        bbMax = [max(inst[3][i] for inst in instances) for i in range(3)]
+        cellData += struct.pack('<III6f', numInstances, len(instances), numCasters, *(bbMin + bbMax))
+        for inst in instances:
+            m = inst[1]
+            # Column-major
+            instanceData += struct.pack('<16f', *[m[row][col] for col in range(4) for row in range(4)])
+        numInstances += len(instances)
+
+    filename = iset.name + ".instances"
+    f = open(absPath + "/" + filename, 'wb')
+    f.write(b'DINS')
+    f.write(struct.pack('<III', INSTANCES_VERSION, len(cells), numInstances))
+    f.write(cellData)
+    f.write(instanceData)
+    f.close()
+    return localPath + filename
+
+def saveInstanceIndex(sets, absPath, localPath):
+    f = open(absPath + "/INSTANCES", 'wb')
+    for iset in sets:
+        line = '%s\t%s\t%s\n' % (localPath + iset.name + ".instances",
+            localPath + iset.meshObject.data.name + ".obj",
+            iset.material.name if iset.material else '')
+        f.write(line.encode('utf-8'))
+    f.close()
+
+# Spatial chunks (see asset-format-spec.md)
+
+def objectTree(ob, objectNames):
+    # Object followed by its descendants, parents first
+    result = [ob]
+    for child in sorted(ob.children, key = lambda c: c.name):
+        if child.name in objectNames:
+            result += objectTree(child, objectNames)
+    return result
+
+def objectBounds(obs):
+    # World space bounding box of objects in Dagon coordinates (Y-up)
+    global_matrix = bpy_extras.io_utils.axis_conversion(to_forward="-Z", to_up="Y").to_4x4()
+    bbMin = None
+    bbMax = None
+    for ob in obs:
+        if ob.type == 'MESH':
+            points = [global_matrix * ob.matrix_world * mathutils.Vector(c) for c in ob.bound_box]
+        else:
+            points = [global_matrix * ob.matrix_world.to_translation()]
+        for p in points:
+            if bbMin is None:
+                bbMin = p.copy()
+                bbMax = p.copy()
+            else:
+                for i in range(3):
+                    bbMin[i] = min(bbMin[i], p[i])
+                    bbMax[i] = max(bbMax[i], p[i])
+    return bbMin, bbMax
+
+def materialDependencies(mat, localPath, useSceneTable):
+    props = mat.dagonProps
+    deps = []
+    if not useSceneTable:
+        deps.append(localPath + mat.name + ".mat")
+    textures = [props.dagonDiffuseTexture, props.dagonRoughnessTexture, props.dagonMetallicTexture,
+                props.dagonEmissionTexture, props.dagonNormalTexture, props.dagonHeightTexture]
+    for imageName in textures:
+        if len(imageName):
+            deps.append(localPath + os.path.basename(textureAbsPath(imageName)))
+    return deps
+
+def makeChunks(objects, chunkSize, localPath, useSceneTable):
+    # Groups object trees into cells of a horizontal (XZ) grid by the centers of their bounding boxes.
+    # Returns a list of (name, bbMin, bbMax, entity filenames, dependencies) sorted by name
+    objectNames = set(ob.name for ob in objects)
+    cells = {}
+    for ob in objects:
+        if ob.parent and ob.parent.name in objectNames:
+            continue
+        tree = objectTree(ob, objectNames)
+        bbMin, bbMax = objectBounds(tree)
+        center = (bbMin + bbMax) * 0.5
+        cell = (int(floor(center.x / chunkSize)), int(floor(center.z / chunkSize)))
+        cells.setdefault(cell, []).append((tree, bbMin, bbMax))
+
+    chunks = []
+    for cell in sorted(cells):
+        name = '%d_%d' % cell
+        chunkMin = None
+        chunkMax = None
+        entities = []
+        deps = []
+        for tree, bbMin, bbMax in cells[cell]:
+            if chunkMin is None:
+                chunkMin = bbMin.copy()
+                chunkMax = bbMax.copy()
+            else:
+                for i in range(3):
+                    chunkMin[i] = min(chunkMin[i], bbMin[i])
+                    chunkMax[i] = max(chunkMax[i], bbMax[i])
+            for ob in tree:
+                entities.append(localPath + ob.name + ".entity")
+                if ob.type == 'MESH':
+                    # Shared meshes, materials and textures are stored once in the package
+                    # and listed in every chunk that uses them
+                    chunkDeps = [localPath + ob.data.name + ".obj"]
+                    if len(ob.data.materials) > 0 and ob.data.materials[0]:
+                        chunkDeps += materialDependencies(ob.data.materials[0], localPath, useSceneTable)
+                    for d in chunkDeps:
+                        if not d in deps:
+                            deps.append(d)
+        chunks.append((name, chunkMin, chunkMax, entities, deps))
+    return chunks
+
+def saveChunks(chunks, absPath):
+    # Writes CHUNKS and chunk index and dependency files, returns their filenames in the package
+    filenames = ["CHUNKS"]
+    f = open(absPath + "/CHUNKS", 'wb')
+    for name, bbMin, bbMax, entities, deps in chunks:
+        line = '%s %s %s %s %s %s %s\n' % (name, bbMin.x, bbMin.y, bbMin.z, bbMax.x, bbMax.y, bbMax.z)
+        f.write(bytearray(line.encode('ascii')))
+
+        chunkDir = "chunks/" + name
+        os.makedirs(absPath + "/" + chunkDir)
+        saveIndexFile(entities, absPath + "/" + chunkDir, "")
+        df = open(absPath + "/" + chunkDir + "/DEPS", 'wb')
+        for d in deps:
+            df.write(bytearray(('%s\n' % (d)).encode('ascii')))
+        df.close()
+        filenames.append(chunkDir + "/INDEX")
+        filenames.append(chunkDir + "/DEPS")
+    f.close()
+    return filenames
+
 def saveIndexFile(entities, absPath, dirLocal):
     indexAbsPath = absPath + "/INDEX"
     f = open(indexAbsPath, 'wb')
@@ -329,7 +1232,220 @@ def saveIndexFile(entities, absPath, dirLocal):
         f.write(bytearray(estr.encode('ascii')))
     f.close()
 
-def doExport(context, filepath = ""):
+# Extended Box format (see asset-format-spec.md)
+BOX_VERSION = 3
+BOX_HEADER_SIZE = 32
+BOX_ENTRY_COMPRESSED = 1
+
+# Already compressed formats that zlib can't shrink further
+uncompressibleExtensions = ['.png', '.jpg', '.jpeg']
+
+def shouldCompress(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    return not ext in uncompressibleExtensions
+
+def boxHash(filename):
+    # 64-bit FNV-1a, 0 is reserved for empty slots
+    h = 14695981039346656037
+    for c in filename.encode('ascii'):
+        h = h ^ c
+        h = (h * 1099511628211) & 0xFFFFFFFFFFFFFFFF
+    if h == 0:
+        h = 1
+    return h
+
+def packBoxHashTable(entryRecords):
+    # Open addressing with linear probing, load factor is at most 0.5
+    numSlots = 2
+    while numSlots < len(entryRecords) * 2:
+        numSlots = numSlots * 2
+    slots = [(0, 0)] * numSlots
+    for filename, recordOffset in entryRecords:
+        h = boxHash(filename)
+        slot = h & (numSlots - 1)
+        while slots[slot][0] != 0:
+            slot = (slot + 1) & (numSlots - 1)
+        slots[slot] = (h, recordOffset)
+    data = bytearray(struct.pack('<Q', numSlots))
+    for h, recordOffset in slots:
+        data += struct.pack('<QQ', h, recordOffset)
+    return data
+
+def saveBoxFile(filepath, localFilenames, absFilenames, useCompression, useHashTable = True):
+    f = open(filepath, 'wb')
+
+    # Header is written again when the index offset is known
+    f.write(bytearray(BOX_HEADER_SIZE))
+
+    # Write data
+    entries = []
+    fileDataOffset = BOX_HEADER_SIZE
+    for i, filename in enumerate(localFilenames):
+        f2 = open(absFilenames[i], 'rb')
+        fileData = f2.read()
+        f2.close()
+        uncompressedSize = len(fileData)
+        flags = 0
+        if useCompression and shouldCompress(filename):
+            compressedData = zlib.compress(fileData, 9)
+            if len(compressedData) < uncompressedSize:
+                fileData = compressedData
+                flags = flags | BOX_ENTRY_COMPRESSED
+        f.write(fileData)
+        entries.append((filename, fileDataOffset, len(fileData), uncompressedSize, flags))
+        fileDataOffset = fileDataOffset + len(fileData)
+
+    # Write index
+    indexOffset = fileDataOffset
+    entryRecords = []
+    for filename, offset, size, uncompressedSize, flags in entries:
+        entryRecords.append((filename, f.tell()))
+        filenameData = bytearray(filename.encode('ascii'))
+        f.write(struct.pack('<I', len(filenameData)))
+        f.write(filenameData)
+        f.write(struct.pack('<QQQI', offset, size, uncompressedSize, flags))
+
+    # Write hash table
+    hashTableOffset = 0
+    if useHashTable:
+        hashTableOffset = f.tell()
+        f.write(packBoxHashTable(entryRecords))
+
+    # Write header
+    f.seek(0)
+    f.write(bytearray('BOXV'.encode('ascii')))
+    f.write(struct.pack('<IQQQ', BOX_VERSION, len(entries), indexOffset, hashTableOffset))
+
+    f.close()
+
+    return entries
+
+# Export report (<package>.report.txt) and budgets
+class BudgetExceeded(Exception):
+    pass
+
+def formatBytes(size):
+    if size >= 1024 * 1024:
+        return '%.2f MB' % (size / (1024.0 * 1024.0))
+    elif size >= 1024:
+        return '%.1f KB' % (size / 1024.0)
+    return '%d B' % size
+
+def objStats(absPath):
+    # Numbers of positions and triangles in an OBJ file
+    numVerts = 0
+    numTris = 0
+    f = open(absPath, 'r')
+    for line in f:
+        if line.startswith('v '):
+            numVerts += 1
+        elif line.startswith('f '):
+            numTris += len(line.split()) - 3
+    f.close()
+    return numVerts, numTris
+
+def imageStats(filename):
+    # Resolution, number of channels and float flag of a packed image, taken from Blender
+    for img in bpy.data.images:
+        if img.filepath and os.path.basename(bpy.path.abspath(img.filepath)) == filename:
+            return img.size[0], img.size[1], img.channels, img.is_float
+    return 0, 0, 0, False
+
+def makeReport(filepath, entries, absFilenames, numMaterials,
+               budgetPackageSize = 0.0, budgetTriangles = 0, budgetTextureSize = 0, budgetMaterials = 0, budgetMemory = 0.0):
+    # Memory estimates follow the engine: OBJ meshes are unindexed, with position, normal
+    # and texcoord per triangle corner, kept in memory after upload. Images are kept too,
+    # textures are RGBA8 (or RGBA32F for HDR) with mipmaps
+    lines = []
+    packageSize = os.path.getsize(filepath)
+    lines.append('Dagon asset export report: %s' % os.path.basename(filepath))
+    lines.append('Package: %d entries, %s (%s uncompressed)' % (len(entries), formatBytes(packageSize), formatBytes(sum([e[3] for e in entries]))))
+
+    lines.append('')
+    lines.append('Entries:')
+    lines.append('%12s %12s  %s' % ('stored', 'uncompressed', 'name'))
+    for (filename, offset, size, uncompressedSize, flags) in sorted(entries, key = lambda e: -e[2]):
+        lines.append('%12d %12d  %s' % (size, uncompressedSize, filename))
+
+    gpuMemory = 0
+    cpuMemory = 0
+    totalTris = 0
+    maxTextureSize = 0
+    meshLines = []
+    textureLines = []
+    hashes = {}
+    for (filename, offset, size, uncompressedSize, flags), absPath in zip(entries, absFilenames):
+        f = open(absPath, 'rb')
+        digest = hashlib.sha1(f.read()).hexdigest()
+        f.close()
+        hashes.setdefault(digest, []).append((filename, uncompressedSize))
+
+        ext = os.path.splitext(filename)[1].lower()
+        if ext == '.obj':
+            numVerts, numTris = objStats(absPath)
+            memory = numTris * (3 * (12 + 12 + 8) + 12)
+            # The OBJ loader doesn't share vertices between triangles
+            acmr = 3.0 if numTris else 0.0
+            meshLines.append('%8d %8d %6.2f %12s  %s' % (numVerts, numTris, acmr, formatBytes(memory), filename))
+            totalTris += numTris
+            gpuMemory += memory
+            cpuMemory += memory
+        elif ext in ['.png', '.jpg', '.bmp', '.tga', '.hdr']:
+            width, height, channels, isFloat = imageStats(os.path.basename(filename))
+            gpu = width * height * (16 if isFloat else 4) * 4 // 3
+            cpu = width * height * channels * (4 if isFloat else 1)
+            textureLines.append('%5d x %-5d %8d %12s %12s  %s' % (width, height, channels, formatBytes(gpu), formatBytes(cpu), filename))
+            maxTextureSize = max(maxTextureSize, width, height)
+            gpuMemory += gpu
+            cpuMemory += cpu
+
+    lines.append('')
+    lines.append('Meshes:')
+    lines.append('%8s %8s %6s %12s  %s' % ('verts', 'tris', 'ACMR', 'memory', 'name'))
+    lines += meshLines
+    lines.append('Total triangles: %d' % totalTris)
+
+    lines.append('')
+    lines.append('Textures:')
+    lines.append('%-13s %8s %12s %12s  %s' % ('resolution', 'channels', 'GPU', 'CPU', 'name'))
+    lines += textureLines
+
+    lines.append('')
+    lines.append('Materials: %d' % numMaterials)
+
+    lines.append('')
+    lines.append('Duplicate content:')
+    for digest, files in sorted(hashes.items(), key = lambda h: h[1][0][0]):
+        if len(files) > 1:
+            lines.append('  %s (%s wasted)' % (' = '.join([name for (name, size) in files]), formatBytes(files[0][1] * (len(files) - 1))))
+
+    lines.append('')
+    lines.append('Estimated memory: GPU %s, CPU %s' % (formatBytes(gpuMemory), formatBytes(cpuMemory)))
+
+    violations = []
+    budgets = [
+        ('Package size', packageSize, budgetPackageSize * 1024 * 1024, formatBytes),
+        ('Triangles', totalTris, budgetTriangles, str),
+        ('Texture size', maxTextureSize, budgetTextureSize, str),
+        ('Materials', numMaterials, budgetMaterials, str),
+        ('GPU memory', gpuMemory, budgetMemory * 1024 * 1024, formatBytes)]
+    lines.append('')
+    lines.append('Budgets:')
+    for (name, value, budget, fmt) in budgets:
+        if budget <= 0:
+            continue
+        exceeded = value > budget
+        lines.append('  %s: %s of %s%s' % (name, fmt(value), fmt(int(budget)), ' EXCEEDED' if exceeded else ''))
+        if exceeded:
+            violations.append('%s %s exceeds budget %s' % (name.lower(), fmt(value), fmt(int(budget))))
+
+    return lines, violations
+
+def doExport(context, filepath = "", useCompression = True, useHashTable = True, useSceneTable = True, useChunks = False, chunkSize = 64.0,
+             useStaticBatching = False, batchCellSize = 32.0, useCollisionBVH = True,
+             useConvexHulls = True, maxHullVertices = 32, useInstancing = False, minInstances = 4, instanceCellSize = 32.0,
+             lodLevels = 0, lodRatio = 0.5, lodScreenSize = 0.5,
+             budgetPackageSize = 0.0, budgetTriangles = 0, budgetTextureSize = 0, budgetMaterials = 0, budgetMemory = 0.0):
     scene = context.scene
 
     dirName = Path(filepath).stem
@@ -348,9 +1464,24 @@ def doExport(context, filepath = ""):
     localFilenames = []
     absFilenames = []
 
-    # Save *.obj and *.entity files
-    for ob in scene.objects:
-        if ob.type == 'MESH':
+    # Entries are written in a stable order, so that exporting the same scene
+    # twice gives identical archives (required by boxpatch.py)
+
+    objects = sorted(scene.objects, key = lambda ob: ob.name)
+    materials = sorted(bpy.data.materials, key = lambda mat: mat.name)
+    numMaterials = len(materials)
+
+    if useStaticBatching:
+        objects = makeStaticBatches(objects, batchCellSize)
+
+    # Save *.obj files
+    for ob in objects:
+        if isinstance(ob, StaticBatch):
+            for batchLocalPath in saveStaticBatch(scene, ob, dirAbs, dirLocal):
+                localFilenames.append(batchLocalPath)
+                absFilenames.append(dirAbs + "/" + os.path.basename(batchLocalPath))
+            meshes.append(ob.data.name)
+        elif ob.type == 'MESH':
             meshName = ob.data.name
             if not meshName in meshes:
                 saveMesh(scene, ob, dirAbs, dirLocal)
@@ -359,7 +1490,69 @@ def doExport(context, filepath = ""):
                 meshAbsPath = dirAbs + "/" + meshName + ".obj"
                 absFilenames.append(meshAbsPath)
                 meshes.append(meshName)
-
+                if lodLevels > 0:
+                    for lodLocalPath in saveMeshLODs(scene, ob, dirAbs, dirLocal, lodLevels, lodRatio, lodScreenSize):
+                        localFilenames.append(lodLocalPath)
+                        absFilenames.append(dirAbs + "/" + os.path.basename(lodLocalPath))
+
+    if useCollisionBVH:
+        # Triangles of solid objects in one prebuilt BVH
+        collisionTriangles = []
+        for ob in objects:
+            if ob.type == 'MESH' and ob.dagonProps.dagonSolid:
+                sources = ob.sources if isinstance(ob, StaticBatch) else [ob]
+                for src in sources:
+                    collisionTriangles += worldTriangles(scene, src)
+        if len(collisionTriangles):
+            saveCollisionBVH(collisionTriangles, dirAbs)
+            localFilenames.append("COLLISION")
+            absFilenames.append(dirAbs + "/COLLISION")
+
+    if useConvexHulls:
+        # Convex collision shapes of solid objects, stored as <object name>.hull
+        for ob in objects:
+            if ob.type == 'MESH' and ob.dagonProps.dagonSolid and not isinstance(ob, StaticBatch):
+                hulls = objectHulls(scene, ob, maxHullVertices)
+                if len(hulls):
+                    hullLocalPath = saveHulls(hulls, dirAbs, dirLocal, ob.name)
+                    localFilenames.append(hullLocalPath)
+                    absFilenames.append(dirAbs + "/" + ob.name + ".hull")
+
+    if useInstancing:
+        # Linked duplicates and dupli instances are rendered with instanced draws
+        instanceSets, objects = makeInstanceSets(scene, objects, minInstances)
+        for iset in instanceSets:
+            meshName = iset.meshObject.data.name
+            if not meshName in meshes:
+                saveMesh(scene, iset.meshObject, dirAbs, dirLocal)
+                localFilenames.append(dirLocal + meshName + ".obj")
+                absFilenames.append(dirAbs + "/" + meshName + ".obj")
+                meshes.append(meshName)
+            instancesLocalPath = saveInstanceSet(iset, instanceCellSize, dirAbs, dirLocal)
+            localFilenames.append(instancesLocalPath)
+            absFilenames.append(dirAbs + "/" + iset.name + ".instances")
+        if len(instanceSets):
+            saveInstanceIndex(instanceSets, dirAbs, dirLocal)
+            localFilenames.append("INSTANCES")
+            absFilenames.append(dirAbs + "/INSTANCES")
+
+    if useChunks:
+        chunks = makeChunks(objects, chunkSize, dirLocal, useSceneTable)
+        for chunkFilename in saveChunks(chunks, dirAbs):
+            localFilenames.append(chunkFilename)
+            absFilenames.append(dirAbs + "/" + chunkFilename)
+
+    if useSceneTable:
+        # Save SCENE file instead of *.entity and *.mat files
+        saveSceneTable(objects, materials, dirAbs, dirLocal)
+        localFilenames.append("SCENE")
+        absFilenames.append(dirAbs + "/SCENE")
+        objects = []
+        materials = []
+
+    # Save *.entity files
+    for ob in objects:
+        if ob.type == 'MESH':
             saveMeshEntity(scene, ob, dirAbs, dirLocal)
             entityFileLocalPath = dirLocal + ob.name + ".entity"
             localFilenames.append(entityFileLocalPath)
@@ -377,59 +1570,42 @@ def doExport(context, filepath = ""):
             
             entities.append(entityFileLocalPath)
 
-    for mat in bpy.data.materials:
+    for mat in materials:
         saveMaterial(scene, mat, dirAbs, dirLocal)
         matLocalPath = dirLocal + mat.name + ".mat"
         localFilenames.append(matLocalPath)
         matAbsPath = dirAbs + "/" + mat.name + ".mat"
         absFilenames.append(matAbsPath)
 
-    for filename in os.listdir(dirAbs + "/"):
+    for filename in sorted(os.listdir(dirAbs + "/")):
         if filename.endswith(".png") or filename.endswith(".jpg") or filename.endswith(".bmp") or filename.endswith(".tga") or filename.endswith(".hdr"):
              texLocalPath = dirLocal + os.path.basename(filename)
              localFilenames.append(texLocalPath)
              texAbsPath = dirAbs + "/" + os.path.basename(filename)
              absFilenames.append(texAbsPath)
         
-    saveIndexFile(entities, dirAbs, dirLocal)
-    indexLocalPath = "INDEX"
-    localFilenames.append(indexLocalPath)
-    indexAbsPath = dirAbs + "/INDEX"
-    absFilenames.append(indexAbsPath)
-
-    fileDataOffset = 12; #initial offset
-    for i, filename in enumerate(localFilenames):
-        fileDataOffset = fileDataOffset + 4; # filename size
-        fileDataOffset = fileDataOffset + len(filename.encode('ascii'))
-        fileDataOffset = fileDataOffset + 8 # data offset
-        fileDataOffset = fileDataOffset + 8 # data size
+    # With chunks, entities are listed in chunk indices instead
+    if not useSceneTable and not useChunks:
+        saveIndexFile(entities, dirAbs, dirLocal)
+        indexLocalPath = "INDEX"
+        localFilenames.append(indexLocalPath)
+        indexAbsPath = dirAbs + "/INDEX"
+        absFilenames.append(indexAbsPath)
 
     # Save *.asset file (Box archive)
+    entries = saveBoxFile(filepath, localFilenames, absFilenames, useCompression, useHashTable)
 
-    # Write header
-    f = open(filepath, 'wb')
-    f.write(bytearray('BOXF'.encode('ascii')))
-    f.write(struct.pack('<Q', len(localFilenames)))
-
-    # Write index
-    for i, filename in enumerate(localFilenames):
-        filenameData = bytearray(filename.encode('ascii'))
-        filePathSize = len(filenameData)
-        fileDataSize = os.path.getsize(absFilenames[i])
-        f.write(struct.pack('<I', filePathSize))
-        f.write(filenameData)
-        f.write(struct.pack('<Q', fileDataOffset))
-        f.write(struct.pack('<Q', fileDataSize))
-        fileDataOffset = fileDataOffset + fileDataSize
-
-    # Write data
-    for i, filename in enumerate(absFilenames):
-        f2 = open(filename, 'rb')
-        fileData = bytearray(f2.read())
-        f.write(fileData)
-        f2.close()
-
+    # Report is written next to the package, a package that exceeds the budgets is removed
+    reportLines, violations = makeReport(filepath, entries, absFilenames, numMaterials,
+        budgetPackageSize, budgetTriangles, budgetTextureSize, budgetMaterials, budgetMemory)
+    f = open(os.path.splitext(filepath)[0] + ".report.txt", 'w')
+    f.write('\n'.join(reportLines) + '\n')
     f.close()
+    print('\n'.join(reportLines))
+
+    if len(violations):
+        os.remove(filepath)
+        raise BudgetExceeded('; '.join(violations))
 
     return {'FINISHED'}
 
@@ -439,6 +1615,27 @@ class ExportDagonAsset(bpy.types.Operator, ExportHelper):
     filename_ext = ".asset"
 
     filter_glob = StringProperty(default = "unknown.asset", options = {"HIDDEN"})
+    useCompression = bpy.props.BoolProperty(name = "Compression", description = "Compress entries with zlib (already compressed images are stored as is)", default = True)
+    useHashTable = bpy.props.BoolProperty(name = "Hash Table", description = "Write a hash table for fast lookups of entries in large packages", default = True)
+    useSceneTable = bpy.props.BoolProperty(name = "Scene Table", description = "Write entities and materials to a single binary table instead of text files", default = True)
+    useChunks = bpy.props.BoolProperty(name = "Chunks", description = "Partition objects into a grid of chunks for streaming", default = False)
+    chunkSize = bpy.props.FloatProperty(name = "Chunk Size", description = "Size of a chunk cell in meters", default = 64.0, min = 1.0)
+    useStaticBatching = bpy.props.BoolProperty(name = "Static Batching", description = "Merge static objects that share a material into one mesh per cell", default = False)
+    batchCellSize = bpy.props.FloatProperty(name = "Batch Cell Size", description = "Size of a static batching cell in meters", default = 32.0, min = 1.0)
+    useCollisionBVH = bpy.props.BoolProperty(name = "Collision BVH", description = "Prebuild a BVH of solid objects for collision detection", default = True)
+    useConvexHulls = bpy.props.BoolProperty(name = "Convex Hulls", description = "Save convex hulls of solid objects for collision detection", default = True)
+    maxHullVertices = bpy.props.IntProperty(name = "Max Hull Vertices", description = "Maximum number of vertices in a convex hull", default = 32, min = 4, max = 256)
+    useInstancing = bpy.props.BoolProperty(name = "Instancing", description = "Render linked duplicates and dupli instances with instanced draws", default = False)
+    minInstances = bpy.props.IntProperty(name = "Min Instances", description = "Minimum number of linked duplicates to make an instance set", default = 4, min = 2)
+    instanceCellSize = bpy.props.FloatProperty(name = "Instance Cell Size", description = "Size of an instance culling cell in meters", default = 32.0, min = 1.0)
+    lodLevels = bpy.props.IntProperty(name = "LOD Levels", description = "Number of simplified levels of detail of meshes (0 to disable)", default = 0, min = 0, max = 8)
+    lodRatio = bpy.props.FloatProperty(name = "LOD Ratio", description = "Fraction of triangles kept in each next level of detail", default = 0.5, min = 0.05, max = 0.95)
+    lodScreenSize = bpy.props.FloatProperty(name = "LOD Screen Size", description = "Screen size below which the first simplified level is used, halved for each next level", default = 0.5, min = 0.01, max = 2.0)
+    budgetPackageSize = bpy.props.FloatProperty(name = "Max Package Size", description = "Fail the export if the package is larger, in megabytes (0 for no limit)", default = 0.0, min = 0.0)
+    budgetTriangles = bpy.props.IntProperty(name = "Max Triangles", description = "Fail the export if meshes have more triangles in total (0 for no limit)", default = 0, min = 0)
+    budgetTextureSize = bpy.props.IntProperty(name = "Max Texture Size", description = "Fail the export if a texture is larger in any dimension, in pixels (0 for no limit)", default = 0, min = 0)
+    budgetMaterials = bpy.props.IntProperty(name = "Max Materials", description = "Fail the export if there are more materials (0 for no limit)", default = 0, min = 0)
+    budgetMemory = bpy.props.FloatProperty(name = "Max GPU Memory", description = "Fail the export if meshes and textures need more GPU memory, in megabytes (0 for no limit)", default = 0.0, min = 0.0)
 
     @classmethod
     def poll(cls, context):
@@ -447,7 +1644,15 @@ class ExportDagonAsset(bpy.types.Operator, ExportHelper):
     def execute(self, context):
         filepath = self.filepath
         filepath = bpy.path.ensure_ext(filepath, self.filename_ext)           
-        return doExport(context, filepath)
+        try:
+            return doExport(context, filepath, self.useCompression, self.useHashTable, self.useSceneTable, self.useChunks, self.chunkSize,
+                self.useStaticBatching, self.batchCellSize, self.useCollisionBVH,
+                self.useConvexHulls, self.maxHullVertices, self.useInstancing, self.minInstances, self.instanceCellSize,
+                self.lodLevels, self.lodRatio, self.lodScreenSize,
+                self.budgetPackageSize, self.budgetTriangles, self.budgetTextureSize, self.budgetMaterials, self.budgetMemory)
+        except BudgetExceeded as e:
+            self.report({'ERROR'}, "Export budget exceeded: " + str(e))
+            return {'CANCELLED'}
 
     def invoke(self, context, event):
         wm = context.window_manager
@@ -471,6 +1676,7 @@ class DagonObjectProps(bpy.types.PropertyGroup):
     dagonCastShadow = bpy.props.BoolProperty(name="Cast Shadow", default=True)
     dagonUseMotionBlur = bpy.props.BoolProperty(name="Motion Blur", default=True)
     dagonLayer = bpy.props.IntProperty(name="Layer", default=1)
+    dagonStatic = bpy.props.BoolProperty(name="Static", default=False)
     
 class DagonObjectPropsPanel(bpy.types.Panel):
     bl_label = "Dagon Properties"
@@ -500,6 +1706,7 @@ class DagonObjectPropsPanel(bpy.types.Panel):
 
         col = self.layout.column(align=True)
         col.prop(props, 'dagonLayer')
+        col.prop(props, 'dagonStatic')
 
 ParallaxModeEnum = [
     ('ParallaxNone', "None", "", 0),
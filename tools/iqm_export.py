@@ -12,7 +12,7 @@ bl_info = {
     "tracker_url": "",
     "category": "Import-Export"}
 
-import os, struct, math
+import os, io, struct, math, heapq, hashlib
 import mathutils
 import bpy
 import bpy_extras.io_utils
@@ -117,6 +117,8 @@ class Mesh:
         self.verts     = [ None for v in verts ]
         self.vertmap   = {}
         self.tris      = []
+        self.lod       = 0
+        self.image     = None
    
     def calcTangents(self):
         # See "Tangent Space Calculation" at http://www.terathon.com/code/tangent.html
@@ -216,10 +218,398 @@ class Mesh:
         # print('%s: %d tris scheduled to %d' % (self.name, len(self.tris), len(trischedule)))         
         self.tris = trischedule                 
 
+    def optimizeOverdraw(self, threshold = 1.05):
+        # Triangle reordering for reduced overdraw by Sander, Nehab and Barczak:
+        # the vertex cache optimized order is split into clusters, where the cache
+        # is flushed anyway (hard boundaries) or where the ACMR of the cluster is within
+        # threshold of the ACMR of the mesh (soft boundaries). Clusters are sorted,
+        # so that the outer ones that face away from the center are drawn first
+        if len(self.tris) < 2:
+            return
+
+        acmr = calcACMR(self.tris)
+        overdraw = estimateOverdraw(self.tris)
+
+        clusters = []
+        start = 0
+        for i, misses in enumerate(cacheMisses(self.tris)):
+            if i > start and misses == 3:
+                clusters.append((start, i))
+                start = i
+        clusters.append((start, len(self.tris)))
+
+        softclusters = []
+        for (start, end) in clusters:
+            first = start
+            cache = []
+            misses = 0
+            for i in range(start, end):
+                for v in self.tris[i]:
+                    key = id(v)
+                    if key in cache:
+                        cache.remove(key)
+                    else:
+                        misses += 1
+                    cache.insert(0, key)
+                del cache[MAXVCACHE:]
+                count = i + 1 - first
+                if i + 1 < end and count >= 8 and float(misses) / count <= threshold * acmr:
+                    softclusters.append((first, i + 1))
+                    first = i + 1
+                    cache = []
+                    misses = 0
+            softclusters.append((first, end))
+
+        center = mathutils.Vector((0.0, 0.0, 0.0))
+        totalarea = 0.0
+        for (v0, v1, v2) in self.tris:
+            area = (v2.coord - v0.coord).cross(v1.coord - v0.coord).length
+            center += (v0.coord + v1.coord + v2.coord) * (area / 3.0)
+            totalarea += area
+        if totalarea <= 0.0:
+            return
+        center /= totalarea
+
+        def clusterKey(cluster):
+            (start, end) = cluster
+            c = mathutils.Vector((0.0, 0.0, 0.0))
+            n = mathutils.Vector((0.0, 0.0, 0.0))
+            area = 0.0
+            for (v0, v1, v2) in self.tris[start:end]:
+                # Quake winding is reversed
+                fn = (v2.coord - v0.coord).cross(v1.coord - v0.coord)
+                a = fn.length
+                c += (v0.coord + v1.coord + v2.coord) * (a / 3.0)
+                n += fn
+                area += a
+            if area <= 0.0 or n.length <= 0.0:
+                return 0.0
+            c /= area
+            n.normalize()
+            return (c - center).dot(n)
+
+        softclusters.sort(key = clusterKey, reverse = True)
+        tris = []
+        for (start, end) in softclusters:
+            tris += self.tris[start:end]
+        self.tris = tris
+
+        # Vertices are fetched in the order of first use
+        verts = []
+        for v in self.verts:
+            v.index = -1
+        for tri in self.tris:
+            for v in tri:
+                if v.index < 0:
+                    v.index = len(verts)
+                    verts.append(v)
+        self.verts = verts
+
+        print('%s: %d clusters, ACMR %.3f -> %.3f, overdraw %.3f -> %.3f' % (self.name, len(softclusters), acmr, calcACMR(self.tris), overdraw, estimateOverdraw(self.tris)))
+
     def meshData(self, iqm):
         return [ iqm.addText(self.name), iqm.addText(self.material), self.firstvert, len(self.verts), self.firsttri, len(self.tris) ]
 
 
+def cacheMisses(tris, cachesize = MAXVCACHE):
+    # Number of misses of each triangle in a simulated LRU post-transform cache
+    cache = []
+    result = []
+    for tri in tris:
+        misses = 0
+        for v in tri:
+            key = id(v)
+            if key in cache:
+                cache.remove(key)
+            else:
+                misses += 1
+            cache.insert(0, key)
+        del cache[cachesize:]
+        result.append(misses)
+    return result
+
+def calcACMR(tris, cachesize = MAXVCACHE):
+    # Average cache miss ratio: vertex shader invocations per triangle
+    if not tris:
+        return 0.0
+    return float(sum(cacheMisses(tris, cachesize))) / len(tris)
+
+OVERDRAW_RESOLUTION = 64
+OVERDRAW_DIRECTIONS = [ (1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1) ]
+
+def estimateOverdraw(tris, resolution = OVERDRAW_RESOLUTION):
+    # Rasterizes front-facing triangles in order with depth test from the axis directions
+    # at low resolution. Overdraw is the number of shaded pixels per covered pixel
+    shaded = 0
+    covered = 0
+    for d in OVERDRAW_DIRECTIONS:
+        axis = [ k for k in range(3) if d[k] == 0 ]
+        depthaxis = [ k for k in range(3) if d[k] != 0 ][0]
+        sign = d[depthaxis]
+        coords = [ v.coord for tri in tris for v in tri ]
+        umin = min([ c[axis[0]] for c in coords ])
+        umax = max([ c[axis[0]] for c in coords ])
+        wmin = min([ c[axis[1]] for c in coords ])
+        wmax = max([ c[axis[1]] for c in coords ])
+        extent = max(umax - umin, wmax - wmin)
+        if extent <= 0.0:
+            continue
+        scale = resolution / extent
+        depth = {}
+        for (v0, v1, v2) in tris:
+            # Viewer looks along d, Quake winding is reversed
+            fn = (v2.coord - v0.coord).cross(v1.coord - v0.coord)
+            if fn[depthaxis] * sign >= 0.0:
+                continue
+            p = [ ((c[axis[0]] - umin) * scale, (c[axis[1]] - wmin) * scale, c[depthaxis] * sign) for c in (v0.coord, v1.coord, v2.coord) ]
+            area = (p[1][0] - p[0][0]) * (p[2][1] - p[0][1]) - (p[2][0] - p[0][0]) * (p[1][1] - p[0][1])
+            if area == 0.0:
+                continue
+            x0 = max(0, int(math.floor(min(q[0] for q in p))))
+            x1 = min(resolution - 1, int(math.ceil(max(q[0] for q in p))))
+            y0 = max(0, int(math.floor(min(q[1] for q in p))))
+            y1 = min(resolution - 1, int(math.ceil(max(q[1] for q in p))))
+            for y in range(y0, y1 + 1):
+                py = y + 0.5
+                for x in range(x0, x1 + 1):
+                    px = x + 0.5
+                    b0 = ((p[1][0] - px) * (p[2][1] - py) - (p[2][0] - px) * (p[1][1] - py)) / area
+                    b1 = ((p[2][0] - px) * (p[0][1] - py) - (p[0][0] - px) * (p[2][1] - py)) / area
+                    b2 = 1.0 - b0 - b1
+                    if b0 < 0.0 or b1 < 0.0 or b2 < 0.0:
+                        continue
+                    z = b0 * p[0][2] + b1 * p[1][2] + b2 * p[2][2]
+                    old = depth.get((x, y))
+                    if old is None or z < old:
+                        depth[(x, y)] = z
+                        shaded += 1
+        covered += len(depth)
+    if covered == 0:
+        return 0.0
+    return float(shaded) / covered
+
+
+LOD_WEIGHT_PENALTY = 4.0
+
+def floatToHalf(x):
+    # Bits of IEEE 754 half-float nearest to x (ties to even).
+    # Struct format 'e' does the same, but it needs Python 3.6
+    bits, = struct.unpack('<Q', struct.pack('<d', x))
+    sign = (bits >> 48) & 0x8000
+    exp = (bits >> 52) & 0x7FF
+    mant = bits & 0xFFFFFFFFFFFFF
+    if exp == 0x7FF:
+        return sign | 0x7C00 | (0x200 if mant else 0)
+    e = exp - 1023 + 15
+    if e >= 0x1F:
+        return sign | 0x7C00
+    if e <= 0:
+        # Subnormal half-float
+        if e < -11:
+            return sign
+        mant |= 1 << 52
+        shift = 43 - e
+    else:
+        shift = 42
+    h = mant >> shift
+    if e > 0:
+        h |= e << 10
+    rem = mant & ((1 << shift) - 1)
+    halfway = 1 << (shift - 1)
+    # Rounding up may carry into the exponent, which gives the right result up to infinity
+    if rem > halfway or (rem == halfway and (h & 1)):
+        h += 1
+    return sign | h
+
+def planeQuadric(p0, p1, p2):
+    n = (p1 - p0).cross(p2 - p0)
+    area = n.length
+    if area <= 0.0:
+        return [0.0] * 10
+    n = n / area
+    a, b, c = n.x, n.y, n.z
+    d = -n.dot(p0)
+    w = area * 0.5
+    return [w*a*a, w*a*b, w*a*c, w*a*d, w*b*b, w*b*c, w*b*d, w*c*c, w*c*d, w*d*d]
+
+def quadricError(q, p):
+    x, y, z = p.x, p.y, p.z
+    return (q[0]*x*x + 2.0*q[1]*x*y + 2.0*q[2]*x*z + 2.0*q[3]*x +
+            q[4]*y*y + 2.0*q[5]*y*z + 2.0*q[6]*y +
+            q[7]*z*z + 2.0*q[8]*z + q[9])
+
+def weightDistance(v0, v1):
+    # Difference of bone influences in [0, 2]
+    w = {}
+    for (weight, bone) in v0.weights:
+        w[bone] = w.get(bone, 0) + weight
+    for (weight, bone) in v1.weights:
+        w[bone] = w.get(bone, 0) - weight
+    return sum([ abs(x) for x in w.values() ]) / 255.0
+
+def simplifyMesh(mesh, ratio, level, basename):
+    # Quadric error edge collapse (Garland-Heckbert), reduces the number of triangles by ratio.
+    # Vertices are collapsed into their neighbors, so that texture coordinates, normals
+    # and bone weights of the remaining vertices are exact. Vertices on UV seams, hard edges
+    # and borders (including borders between materials) are never removed, so the LOD has
+    # no cracks, and collapses between vertices with different bone weights are penalized
+    verts = []
+    vindex = {}
+    tris = []
+    for tri in mesh.tris:
+        t = []
+        for v in tri:
+            i = vindex.get(id(v))
+            if i is None:
+                i = len(verts)
+                vindex[id(v)] = i
+                verts.append(v)
+            t.append(i)
+        tris.append(t)
+
+    pos = [ v.coord for v in verts ]
+    poskey = [ (p.x, p.y, p.z) for p in pos ]
+
+    locked = [ False ] * len(verts)
+    copies = {}
+    for i, key in enumerate(poskey):
+        copies[key] = copies.get(key, 0) + 1
+    edges = {}
+    for t in tris:
+        for k in range(3):
+            a, b = poskey[t[k]], poskey[t[(k + 1) % 3]]
+            e = (a, b) if a < b else (b, a)
+            edges[e] = edges.get(e, 0) + 1
+    border = set()
+    for (a, b), n in edges.items():
+        if n == 1:
+            border.add(a)
+            border.add(b)
+    for i, key in enumerate(poskey):
+        if copies[key] > 1 or key in border:
+            locked[i] = True
+
+    quadrics = [ [0.0] * 10 for v in verts ]
+    vtris = [ set() for v in verts ]
+    for ti, t in enumerate(tris):
+        q = planeQuadric(pos[t[0]], pos[t[1]], pos[t[2]])
+        for i in t:
+            vtris[i].add(ti)
+            quadrics[i] = [ a + b for (a, b) in zip(quadrics[i], q) ]
+
+    alive = [ True ] * len(verts)
+    stamps = [ 0 ] * len(verts)
+
+    def neighbors(u):
+        result = set()
+        for ti in vtris[u]:
+            result.update(tris[ti])
+        result.discard(u)
+        return result
+
+    def canCollapse(u, v):
+        # Link condition keeps the mesh manifold
+        shared = neighbors(u) & neighbors(v)
+        edgeTris = [ ti for ti in vtris[u] if v in tris[ti] ]
+        if len(shared) > len(edgeTris):
+            return False
+        # Triangles that remain should not flip
+        for ti in vtris[u]:
+            t = tris[ti]
+            if v in t:
+                continue
+            p = [ pos[i] for i in t ]
+            n0 = (p[1] - p[0]).cross(p[2] - p[0])
+            p = [ pos[v] if i == u else pos[i] for i in t ]
+            n1 = (p[1] - p[0]).cross(p[2] - p[0])
+            if n0.dot(n1) <= 0.0:
+                return False
+        return True
+
+    def bestCollapse(u):
+        best = None
+        for v in neighbors(u):
+            q = [ a + b for (a, b) in zip(quadrics[u], quadrics[v]) ]
+            cost = quadricError(q, pos[v])
+            cost += LOD_WEIGHT_PENALTY * weightDistance(verts[u], verts[v]) * (pos[u] - pos[v]).length_squared
+            if (best is None or cost < best[0]) and canCollapse(u, v):
+                best = (cost, v)
+        return best
+
+    heap = []
+    def push(u):
+        stamps[u] += 1
+        if locked[u] or not alive[u]:
+            return
+        best = bestCollapse(u)
+        if best:
+            heapq.heappush(heap, (best[0], u, best[1], stamps[u]))
+
+    for u in range(len(verts)):
+        push(u)
+
+    numTris = len(tris)
+    target = int(numTris * ratio)
+    while numTris > target and heap:
+        cost, u, v, stamp = heapq.heappop(heap)
+        if stamp != stamps[u] or not alive[u] or not alive[v]:
+            continue
+        if v not in neighbors(u) or not canCollapse(u, v):
+            push(u)
+            continue
+        for ti in list(vtris[u]):
+            t = tris[ti]
+            if v in t:
+                for i in t:
+                    vtris[i].discard(ti)
+                tris[ti] = None
+                numTris -= 1
+            else:
+                t[t.index(u)] = v
+                vtris[v].add(ti)
+        vtris[u] = set()
+        alive[u] = False
+        quadrics[v] = [ a + b for (a, b) in zip(quadrics[u], quadrics[v]) ]
+        for w in neighbors(v):
+            push(w)
+        push(v)
+
+    lodmesh = Mesh('%s@lod%d' % (basename, level), mesh.material, [])
+    lodmesh.lod = level
+    lodmesh.image = mesh.image
+    copiesByIndex = {}
+    for t in tris:
+        if t is None:
+            continue
+        tri = []
+        for i in t:
+            if i not in copiesByIndex:
+                v = verts[i]
+                vcopy = Vertex(len(lodmesh.verts), v.coord, v.normal, v.uv, v.weights, v.color)
+                copiesByIndex[i] = vcopy
+                lodmesh.verts.append(vcopy)
+            tri.append(copiesByIndex[i])
+        lodmesh.tris.append(tuple(tri))
+    return lodmesh
+
+def makeLODs(meshes, lodlevels, lodratio):
+    # Every level has a mesh for each base mesh, levels are stored one after another.
+    # The chain ends when a level doesn't reduce the number of triangles enough
+    # Each level is simplified from the previous one, but named after the base mesh
+    lods = []
+    prev = meshes
+    for level in range(1, lodlevels + 1):
+        cur = [ simplifyMesh(mesh, lodratio, level, base.name) for (mesh, base) in zip(prev, meshes) ]
+        prevTris = sum([ len(mesh.tris) for mesh in prev ])
+        curTris = sum([ len(mesh.tris) for mesh in cur ])
+        if curTris > prevTris * 0.9:
+            break
+        print('LOD %d: %d triangles' % (level, curTris))
+        lods += cur
+        prev = cur
+    return lods
+
+
 class Bone:
     def __init__(self, name, origname, index, parent, matrix):
         self.name = name
@@ -411,6 +801,11 @@ class IQMFile:
         self.animdata = []
         self.framedata = []
         self.vertdata = []
+        self.comment = ''
+        self.halfuv = False
+        self.bytenormals = False
+        self.posbounds = None
+        self.sections = []
 
     def addText(self, str):
         if not self.textdata:
@@ -446,6 +841,14 @@ class IQMFile:
             self.animdata.append(anim.animData(self))
             self.numframes += len(anim.frames)
 
+    def addLODScreenSizes(self, screensize):
+        # Minimum screen size of each level of detail, in "lod <level> <screen size>" lines of the comment
+        numlevels = max([ mesh.lod for mesh in self.meshes ] + [ 0 ]) + 1
+        if numlevels < 2:
+            return
+        for level in range(numlevels):
+            self.comment += 'lod %d %f\n' % (level, screensize * pow(0.5, level))
+
     def calcFrameSize(self):
         for anim in self.anims:
             anim.calcFrameLimits(self.joints)
@@ -457,62 +860,82 @@ class IQMFile:
                 self.posedata.append(joint.poseData(self))
         print('Exporting %d frames of size %d' % (self.numframes, self.framesize))
 
+    def setVertexFormats(self, halfuv = False, bytenormals = False, quantizepos = False):
+        # Compact formats: half-float texcoords, snorm8 normals and tangents,
+        # 16-bit positions relative to the bounds of the model (written to the comment)
+        self.halfuv = halfuv
+        self.bytenormals = bytenormals
+        self.posbounds = None
+        if quantizepos and self.numverts > 0:
+            coords = [ v.coord for mesh in self.meshes for v in mesh.verts ]
+            bmin = [ min([ c[k] for c in coords ]) for k in range(3) ]
+            bmax = [ max([ c[k] for c in coords ]) for k in range(3) ]
+            self.posbounds = (bmin, bmax)
+            self.comment += 'positions %.9g %.9g %.9g %.9g %.9g %.9g\n' % (bmin[0], bmin[1], bmin[2], bmax[0], bmax[1], bmax[2])
+
+    def quantizePosition(self, co):
+        bmin, bmax = self.posbounds
+        q = []
+        for k in range(3):
+            extent = bmax[k] - bmin[k]
+            q.append(int(round((co[k] - bmin[k]) / extent * 65535.0)) if extent > 0.0 else 0)
+        return q
+
+    def vertexArrays(self):
+        # Type, format, number of components, struct format and a function
+        # that gives the components of a vertex, for each vertex array
+        def snorm8(x):
+            return int(round(max(-1.0, min(1.0, x)) * 127.0))
+        arrays = []
+        if self.posbounds:
+            arrays.append((IQM_POSITION, IQM_USHORT, 3, '<3H', lambda v: self.quantizePosition(v.coord)))
+        else:
+            arrays.append((IQM_POSITION, IQM_FLOAT, 3, '<3f', lambda v: v.coord))
+        if self.halfuv:
+            arrays.append((IQM_TEXCOORD, IQM_HALF, 2, '<2H', lambda v: [ floatToHalf(x) for x in v.uv ]))
+        else:
+            arrays.append((IQM_TEXCOORD, IQM_FLOAT, 2, '<2f', lambda v: v.uv))
+        if self.bytenormals:
+            arrays.append((IQM_NORMAL, IQM_BYTE, 3, '<3b', lambda v: [ snorm8(x) for x in v.normal ]))
+            arrays.append((IQM_TANGENT, IQM_BYTE, 4, '<4b', lambda v: [ snorm8(v.tangent.x), snorm8(v.tangent.y), snorm8(v.tangent.z), snorm8(v.bitangent) ]))
+        else:
+            arrays.append((IQM_NORMAL, IQM_FLOAT, 3, '<3f', lambda v: v.normal))
+            arrays.append((IQM_TANGENT, IQM_FLOAT, 4, '<4f', lambda v: (v.tangent.x, v.tangent.y, v.tangent.z, v.bitangent)))
+        if self.joints:
+            arrays.append((IQM_BLENDINDEXES, IQM_UBYTE, 4, '<4B', lambda v: (v.weights[0][1], v.weights[1][1], v.weights[2][1], v.weights[3][1])))
+            arrays.append((IQM_BLENDWEIGHTS, IQM_UBYTE, 4, '<4B', lambda v: (v.weights[0][0], v.weights[1][0], v.weights[2][0], v.weights[3][0])))
+        hascolors = any(mesh.verts and mesh.verts[0].color for mesh in self.meshes)
+        if hascolors:
+            arrays.append((IQM_COLOR, IQM_UBYTE, 4, '<4B', lambda v: v.color if v.color else (0, 0, 0, 255)))
+        return arrays
+
+    def vertexArraySize(self, fmt):
+        # Arrays are padded to 4 bytes
+        size = self.numverts * struct.calcsize(fmt)
+        return size + (4 - size % 4) % 4
+
     def writeVerts(self, file, offset):
         if self.numverts <= 0:
             return
 
-        file.write(IQM_VERTEXARRAY.pack(IQM_POSITION, 0, IQM_FLOAT, 3, offset))
-        offset += self.numverts * struct.calcsize('<3f')
-        file.write(IQM_VERTEXARRAY.pack(IQM_TEXCOORD, 0, IQM_FLOAT, 2, offset))
-        offset += self.numverts * struct.calcsize('<2f')
-        file.write(IQM_VERTEXARRAY.pack(IQM_NORMAL, 0, IQM_FLOAT, 3, offset))
-        offset += self.numverts * struct.calcsize('<3f') 
-        file.write(IQM_VERTEXARRAY.pack(IQM_TANGENT, 0, IQM_FLOAT, 4, offset))
-        offset += self.numverts * struct.calcsize('<4f')
-        if self.joints:
-            file.write(IQM_VERTEXARRAY.pack(IQM_BLENDINDEXES, 0, IQM_UBYTE, 4, offset))
-            offset += self.numverts * struct.calcsize('<4B')
-            file.write(IQM_VERTEXARRAY.pack(IQM_BLENDWEIGHTS, 0, IQM_UBYTE, 4, offset))
-            offset += self.numverts * struct.calcsize('<4B')
-        hascolors = any(mesh.verts and mesh.verts[0].color for mesh in self.meshes)
-        if hascolors:
-            file.write(IQM_VERTEXARRAY.pack(IQM_COLOR, 0, IQM_UBYTE, 4, offset))
-            offset += self.numverts * struct.calcsize('<4B')
+        arrays = self.vertexArrays()
+        for (vtype, vformat, vsize, fmt, values) in arrays:
+            file.write(IQM_VERTEXARRAY.pack(vtype, 0, vformat, vsize, offset))
+            offset += self.vertexArraySize(fmt)
 
-        for mesh in self.meshes:
-            for v in mesh.verts:
-                file.write(struct.pack('<3f', *v.coord))
-        for mesh in self.meshes:
-            for v in mesh.verts:
-                file.write(struct.pack('<2f', *v.uv))
-        for mesh in self.meshes:
-            for v in mesh.verts:
-                file.write(struct.pack('<3f', *v.normal))
-        for mesh in self.meshes:
-            for v in mesh.verts:
-                file.write(struct.pack('<4f', v.tangent.x, v.tangent.y, v.tangent.z, v.bitangent))
-        if self.joints:
-            for mesh in self.meshes:
-                for v in mesh.verts:
-                    file.write(struct.pack('<4B', v.weights[0][1], v.weights[1][1], v.weights[2][1], v.weights[3][1]))
-            for mesh in self.meshes:
-                for v in mesh.verts:
-                    file.write(struct.pack('<4B', v.weights[0][0], v.weights[1][0], v.weights[2][0], v.weights[3][0]))
-        if hascolors:
-            for mesh in self.meshes:
-                for v in mesh.verts:
-                    if v.color:
-                        file.write(struct.pack('<4B', v.color[0], v.color[1], v.color[2], v.color[3]))
-                    else:
-                        file.write(struct.pack('<4B', 0, 0, 0, 255))
+        for (vtype, vformat, vsize, fmt, values) in arrays:
+            data = b''.join([ struct.pack(fmt, *values(v)) for mesh in self.meshes for v in mesh.verts ])
+            file.write(data)
+            file.write(b'\x00' * (self.vertexArraySize(fmt) - len(data)))
 
     def calcNeighbors(self):
+        # Levels of detail overlap in space, so they are not neighbors of each other
         edges = {}
         for mesh in self.meshes:
             for i, (v0, v1, v2) in enumerate(mesh.tris):
-                e0 = v0.neighborKey(v1)
-                e1 = v1.neighborKey(v2)
-                e2 = v2.neighborKey(v0)
+                e0 = (mesh.lod, v0.neighborKey(v1))
+                e1 = (mesh.lod, v1.neighborKey(v2))
+                e2 = (mesh.lod, v2.neighborKey(v0))
                 tri = mesh.firsttri + i
                 try: edges[e0].append(tri)
                 except: edges[e0] = [tri]
@@ -523,9 +946,9 @@ class IQMFile:
         neighbors = []
         for mesh in self.meshes:
             for i, (v0, v1, v2) in enumerate(mesh.tris):
-                e0 = edges[v0.neighborKey(v1)]
-                e1 = edges[v1.neighborKey(v2)]
-                e2 = edges[v2.neighborKey(v0)]
+                e0 = edges[(mesh.lod, v0.neighborKey(v1))]
+                e1 = edges[(mesh.lod, v1.neighborKey(v2))]
+                e2 = edges[(mesh.lod, v2.neighborKey(v0))]
                 tri = mesh.firsttri + i
                 match0 = match1 = match2 = -1
                 if len(e0) == 2: match0 = e0[e0.index(tri)^1]
@@ -560,19 +983,12 @@ class IQMFile:
             ofs_meshes = 0 
         if self.numverts > 0:
             ofs_vertexarrays = self.filesize
-            num_vertexarrays = 4
-            if self.joints:
-                num_vertexarrays += 2
-            hascolors = any(mesh.verts and mesh.verts[0].color for mesh in self.meshes)
-            if hascolors:
-                num_vertexarrays += 1
+            arrays = self.vertexArrays()
+            num_vertexarrays = len(arrays)
             self.filesize += num_vertexarrays * IQM_VERTEXARRAY.size
             ofs_vdata = self.filesize
-            self.filesize += self.numverts * struct.calcsize('<3f2f3f4f')
-            if self.joints:
-                self.filesize += self.numverts * struct.calcsize('<4B4B')
-            if hascolors:
-                self.filesize += self.numverts * struct.calcsize('<4B') 
+            for (vtype, vformat, vsize, fmt, values) in arrays:
+                self.filesize += self.vertexArraySize(fmt)
         else:
             ofs_vertexarrays = 0
             num_vertexarrays = 0
@@ -613,8 +1029,31 @@ class IQMFile:
             self.filesize += self.numframes * IQM_BOUNDS.size
         else:
             ofs_bounds = 0
-
-        file.write(IQM_HEADER.pack('INTERQUAKEMODEL'.encode('ascii'), 2, self.filesize, 0, len(self.textdata), ofs_text, len(self.meshdata), ofs_meshes, num_vertexarrays, self.numverts, ofs_vertexarrays, self.numtris, ofs_triangles, ofs_neighbors, len(self.jointdata), ofs_joints, len(self.posedata), ofs_poses, len(self.animdata), ofs_anims, self.numframes, self.framesize, ofs_frames, ofs_bounds, 0, 0, 0, 0))
+        if self.comment:
+            commentdata = bytes(self.comment, encoding="ascii") + b'\x00'
+            while len(commentdata) % 4:
+                commentdata += b'\x00'
+            ofs_comment = self.filesize
+            self.filesize += len(commentdata)
+        else:
+            commentdata = b''
+            ofs_comment = 0
+
+        self.sections = [ (name, ofs, size) for (name, ofs, size) in [
+            ('header', 0, IQM_HEADER.size),
+            ('text', ofs_text, len(self.textdata)),
+            ('meshes', ofs_meshes, len(self.meshdata) * IQM_MESH.size),
+            ('vertex arrays', ofs_vertexarrays, ofs_triangles - ofs_vertexarrays if ofs_triangles else 0),
+            ('triangles', ofs_triangles, self.numtris * IQM_TRIANGLE.size),
+            ('adjacency', ofs_neighbors, self.numtris * IQM_TRIANGLE.size),
+            ('joints', ofs_joints, len(self.jointdata) * IQM_JOINT.size),
+            ('poses', ofs_poses, len(self.posedata) * IQM_POSE.size),
+            ('animations', ofs_anims, len(self.animdata) * IQM_ANIMATION.size),
+            ('frames', ofs_frames, self.framesize * self.numframes * struct.calcsize('<H') + falign),
+            ('bounds', ofs_bounds, self.numframes * IQM_BOUNDS.size if ofs_bounds else 0),
+            ('comment', ofs_comment, len(commentdata)) ] if size > 0 ]
+
+        file.write(IQM_HEADER.pack('INTERQUAKEMODEL'.encode('ascii'), 2, self.filesize, 0, len(self.textdata), ofs_text, len(self.meshdata), ofs_meshes, num_vertexarrays, self.numverts, ofs_vertexarrays, self.numtris, ofs_triangles, ofs_neighbors, len(self.jointdata), ofs_joints, len(self.posedata), ofs_poses, len(self.animdata), ofs_anims, self.numframes, self.framesize, ofs_frames, ofs_bounds, len(commentdata), ofs_comment, 0, 0))
         file.write(self.textdata)
         for mesh in self.meshdata:
             file.write(IQM_MESH.pack(*mesh))
@@ -632,6 +1071,89 @@ class IQMFile:
         if usebbox and self.numverts > 0 and self.numframes > 0:
             for anim in self.anims:
                 file.write(anim.boundsData(self.joints, self.meshes))
+        file.write(commentdata)
+
+
+def formatBytes(size):
+    if size >= 1024 * 1024:
+        return '%.2f MB' % (size / (1024.0 * 1024.0))
+    elif size >= 1024:
+        return '%.1f KB' % (size / 1024.0)
+    return '%d B' % size
+
+def meshHash(mesh):
+    data = [ (tuple(v.coord), tuple(v.uv), tuple(v.normal)) for v in mesh.verts ]
+    data += [ tuple([ v.index for v in tri ]) for tri in mesh.tris ]
+    return hashlib.sha1(repr(data).encode('ascii')).hexdigest()
+
+def makeReport(iqm, filename, filesize):
+    # Statistics of an exported IQM file. Memory estimates follow the engine's IQM loader:
+    # the file is kept in memory, vertex arrays are decoded to floats, every Actor skins
+    # on the CPU into its own vertex buffers (position, normal, texcoord, indices),
+    # and animation frames are converted to matrices
+    lines = []
+    lines.append('IQM export report: %s' % os.path.basename(filename))
+    lines.append('File size: %s' % formatBytes(filesize))
+
+    lines.append('')
+    lines.append('Sections:')
+    lines.append('%10s %10s  %s' % ('offset', 'size', 'name'))
+    for (name, offset, size) in iqm.sections:
+        lines.append('%10d %10d  %s' % (offset, size, name))
+
+    lines.append('')
+    lines.append('Meshes:')
+    lines.append('%8s %8s %6s %4s  %s' % ('verts', 'tris', 'ACMR', 'lod', 'name'))
+    for mesh in iqm.meshes:
+        lines.append('%8d %8d %6.3f %4d  %s (%s)' % (len(mesh.verts), len(mesh.tris), calcACMR(mesh.tris), mesh.lod, mesh.name, mesh.material))
+    lines.append('Total: %d vertices, %d triangles' % (iqm.numverts, iqm.numtris))
+    lines.append('Bones: %d' % len(iqm.joints))
+    lines.append('Animations: %d, %d frames' % (len(iqm.anims), iqm.numframes))
+    for anim in iqm.anims:
+        lines.append('  %s: %d frames, %.1f fps' % (anim.name, len(anim.frames), anim.fps))
+
+    lines.append('')
+    lines.append('Textures:')
+    images = []
+    for mesh in iqm.meshes:
+        if mesh.image and mesh.image not in images:
+            images.append(mesh.image)
+            lines.append('%5d x %-5d  %s' % (mesh.image.size[0], mesh.image.size[1], os.path.basename(mesh.image.filepath)))
+    maxtexsize = max([ max(image.size[0], image.size[1]) for image in images ] + [ 0 ])
+
+    lines.append('')
+    lines.append('Duplicate content:')
+    meshes = {}
+    for mesh in iqm.meshes:
+        meshes.setdefault(meshHash(mesh), []).append(mesh.name)
+    anims = {}
+    for anim in iqm.anims:
+        anims.setdefault(hashlib.sha1(anim.frameData(iqm.joints)).hexdigest(), []).append(anim.name)
+    for names in list(meshes.values()) + list(anims.values()):
+        if len(names) > 1:
+            lines.append('  ' + ' = '.join(names))
+
+    gpumemory = iqm.numverts * (12 + 12 + 8) + iqm.numtris * 12
+    cpumemory = filesize + iqm.numverts * (12 + 12 + 8 + 33) + iqm.numframes * len(iqm.joints) * 64
+    actormemory = iqm.numverts * 24
+    lines.append('')
+    lines.append('Estimated memory: GPU %s per actor, CPU %s + %s per actor' % (formatBytes(gpumemory), formatBytes(cpumemory), formatBytes(actormemory)))
+
+    return lines, maxtexsize
+
+def checkBudgets(lines, budgets):
+    # budgets: (name, value, limit) with zero limit for no limit
+    violations = []
+    lines.append('')
+    lines.append('Budgets:')
+    for (name, value, limit) in budgets:
+        if limit <= 0:
+            continue
+        exceeded = value > limit
+        lines.append('  %s: %d of %d%s' % (name, value, limit, ' EXCEEDED' if exceeded else ''))
+        if exceeded:
+            violations.append('%s %d exceeds budget %d' % (name.lower(), value, limit))
+    return violations
 
 
 def findArmature(context):
@@ -807,7 +1329,7 @@ def collectAnims(context, armature, scale, bones, animspecs):
     return anims
 
  
-def collectMeshes(context, bones, scale, matfun, useskel = True, usecol = False, filetype = 'IQM'):
+def collectMeshes(context, bones, scale, matfun, useskel = True, usecol = False, filetype = 'IQM', lodlevels = 0, lodratio = 0.5, overdraw = False, overdrawthreshold = 1.05):
     vertwarn = []
     objs = context.selected_objects #context.scene.objects
     meshes = []
@@ -857,6 +1379,7 @@ def collectMeshes(context, bones, scale, matfun, useskel = True, usecol = False,
                     except:
                         matprefix = ''
                     mesh = Mesh(obj.name, matfun(matprefix, material), data.vertices)
+                    mesh.image = uvface.image if uvface else None
                     meshes.append(mesh)
                     materials[obj.name, matindex, material] = mesh
 
@@ -936,8 +1459,13 @@ def collectMeshes(context, bones, scale, matfun, useskel = True, usecol = False,
                 for i in range(2, len(faceverts)):
                     mesh.tris.append((faceverts[0], faceverts[i], faceverts[i-1])) 
  
+    if filetype == 'IQM' and lodlevels > 0:
+        meshes += makeLODs(meshes, lodlevels, lodratio)
+
     for mesh in meshes:
         mesh.optimize()
+        if overdraw:
+            mesh.optimizeOverdraw(overdrawthreshold)
         if filetype == 'IQM':
             mesh.calcTangents()
         print('%s %s: generated %d triangles' % (mesh.name, mesh.material, len(mesh.tris)))
@@ -1003,7 +1531,7 @@ def exportIQE(file, meshes, bones, anims):
     file.write('\n')
 
 
-def exportIQM(context, filename, usemesh = True, useskel = True, usebbox = True, usecol = False, scale = 1.0, animspecs = None, matfun = (lambda prefix, image: image), derigify = False, boneorder = None):
+def exportIQM(context, filename, usemesh = True, useskel = True, usebbox = True, usecol = False, scale = 1.0, animspecs = None, matfun = (lambda prefix, image: image), derigify = False, boneorder = None, lodlevels = 0, lodratio = 0.5, lodscreensize = 0.5, halfuv = False, bytenormals = False, quantizepos = False, overdraw = False, overdrawthreshold = 1.05, budgetsize = 0, budgettris = 0, budgetbones = 0, budgetframes = 0, budgettexsize = 0):
     armature = findArmature(context)
     if useskel and not armature:
         print('No armature selected')
@@ -1043,7 +1571,7 @@ def exportIQM(context, filename, usemesh = True, useskel = True, usebbox = True,
 
     bonelist = sorted(bones.values(), key = lambda bone: bone.index)
     if usemesh:
-        meshes = collectMeshes(context, bones, scale, matfun, useskel, usecol, filetype)
+        meshes = collectMeshes(context, bones, scale, matfun, useskel, usecol, filetype, lodlevels, lodratio, overdraw, overdrawthreshold)
     else:
         meshes = []
     if useskel and animspecs:
@@ -1056,9 +1584,35 @@ def exportIQM(context, filename, usemesh = True, useskel = True, usebbox = True,
         iqm.addMeshes(meshes)
         iqm.addJoints(bonelist)
         iqm.addAnims(anims)
+        iqm.addLODScreenSizes(lodscreensize)
+        iqm.setVertexFormats(halfuv, bytenormals, quantizepos)
         iqm.calcFrameSize()
         iqm.calcNeighbors()
 
+        # The file is built in memory and written only if it fits the budgets
+        data = io.BytesIO()
+        iqm.export(data, usebbox)
+        data = data.getvalue()
+
+        report, maxtexsize = makeReport(iqm, filename, len(data))
+        violations = checkBudgets(report, [
+            ('Size (KB)', (len(data) + 1023) // 1024, budgetsize),
+            ('Triangles', iqm.numtris, budgettris),
+            ('Bones', len(iqm.joints), budgetbones),
+            ('Frames', iqm.numframes, budgetframes),
+            ('Texture size', maxtexsize, budgettexsize) ])
+        print('\n'.join(report))
+        if filename:
+            try:
+                file = open(os.path.splitext(filename)[0] + '.report.txt', 'w')
+                file.write('\n'.join(report) + '\n')
+                file.close()
+            except:
+                print('Failed writing report for %s' % (filename))
+        if violations:
+            print('Export budget exceeded: %s' % '; '.join(violations))
+            return False
+
     if filename:
         try:
             if filetype == 'IQM':
@@ -1069,13 +1623,14 @@ def exportIQM(context, filename, usemesh = True, useskel = True, usebbox = True,
             print ('Failed writing to %s' % (filename))
             return
         if filetype == 'IQM':
-            iqm.export(file, usebbox)
+            file.write(data)
         elif filetype == 'IQE':
             exportIQE(file, meshes, bonelist, anims)
         file.close()
         print('Saved %s file to %s' % (filetype, filename))
     else:
         print('No %s file was generated' % (filetype))
+    return True
 
 
 class ExportIQM(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
@@ -1093,6 +1648,19 @@ class ExportIQM(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
     matfmt = bpy.props.EnumProperty(name="Materials", description="Material name format", items=[("m+i-e", "material+image-ext", ""), ("m", "material", ""), ("i", "image", "")], default="m+i-e")
     derigify = bpy.props.BoolProperty(name="De-rigify", description="Export only deformation bones from rigify", default=False)
     boneorder = bpy.props.StringProperty(name="Bone order", description="Override ordering of bones", subtype="FILE_NAME", default="")
+    lodlevels = bpy.props.IntProperty(name="LOD levels", description="Number of simplified levels of detail (IQM only)", default=0, min=0, max=8)
+    lodratio = bpy.props.FloatProperty(name="LOD ratio", description="Fraction of triangles kept in each next level of detail", default=0.5, min=0.05, max=0.95)
+    lodscreensize = bpy.props.FloatProperty(name="LOD screen size", description="Screen size below which the first simplified level is used, halved for each next level", default=0.5, min=0.01, max=2.0)
+    halfuv = bpy.props.BoolProperty(name="Half-float UVs", description="Write texture coordinates as 16-bit floats (IQM only)", default=False)
+    bytenormals = bpy.props.BoolProperty(name="Byte normals", description="Write normals and tangents as signed normalized bytes (IQM only)", default=False)
+    quantizepos = bpy.props.BoolProperty(name="Quantize positions", description="Write positions as 16-bit integers relative to the model bounds (IQM only)", default=False)
+    overdraw = bpy.props.BoolProperty(name="Reduce overdraw", description="Reorder triangle clusters to reduce overdraw after vertex cache optimization", default=False)
+    overdrawthreshold = bpy.props.FloatProperty(name="ACMR threshold", description="Maximum ACMR of triangle clusters relative to the ACMR of the mesh, higher values give smaller clusters", default=1.05, min=1.0, max=3.0, step=5, precision=2)
+    budgetsize = bpy.props.IntProperty(name="Max size (KB)", description="Fail the export if the file is larger (IQM only, 0 for no limit)", default=0, min=0)
+    budgettris = bpy.props.IntProperty(name="Max triangles", description="Fail the export if there are more triangles in total (IQM only, 0 for no limit)", default=0, min=0)
+    budgetbones = bpy.props.IntProperty(name="Max bones", description="Fail the export if there are more bones (IQM only, 0 for no limit)", default=0, min=0)
+    budgetframes = bpy.props.IntProperty(name="Max frames", description="Fail the export if there are more animation frames in total (IQM only, 0 for no limit)", default=0, min=0)
+    budgettexsize = bpy.props.IntProperty(name="Max texture size", description="Fail the export if a texture is larger in any dimension, in pixels (IQM only, 0 for no limit)", default=0, min=0)
 
     def execute(self, context):
         if self.properties.matfmt == "m+i-e":
@@ -1101,7 +1669,9 @@ class ExportIQM(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
             matfun = lambda prefix, image: prefix
         else:
             matfun = lambda prefix, image: image
-        exportIQM(context, self.properties.filepath, self.properties.usemesh, self.properties.useskel, self.properties.usebbox, self.properties.usecol, self.properties.usescale, self.properties.animspec, matfun, self.properties.derigify, self.properties.boneorder)
+        if not exportIQM(context, self.properties.filepath, self.properties.usemesh, self.properties.useskel, self.properties.usebbox, self.properties.usecol, self.properties.usescale, self.properties.animspec, matfun, self.properties.derigify, self.properties.boneorder, self.properties.lodlevels, self.properties.lodratio, self.properties.lodscreensize, self.properties.halfuv, self.properties.bytenormals, self.properties.quantizepos, self.properties.overdraw, self.properties.overdrawthreshold, self.properties.budgetsize, self.properties.budgettris, self.properties.budgetbones, self.properties.budgetframes, self.properties.budgettexsize):
+            self.report({'ERROR'}, 'Export failed, see the console for details')
+            return {'CANCELLED'}
         return {'FINISHED'}
 
     def check(self, context):
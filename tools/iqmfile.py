@@ -0,0 +1,795 @@
+#!/usr/bin/env python3
+#
+# IQM model library and command line tool.
+# Reads the layout written by iqm_export.py without Blender, so exported
+# models can be checked and compared outside of the engine.
+#
+# Usage:
+#   iqmfile.py info <model> [--cache <sizes>] [--no-bounds]
+#   iqmfile.py verify <model>
+#   iqmfile.py diff <model> <model> [--cache <sizes>]
+#
+# See asset-format-spec.md for the format description.
+
+import os
+import sys
+import math
+import struct
+import argparse
+
+IQM_MAGIC = b'INTERQUAKEMODEL\x00'
+IQM_VERSION = 2
+
+IQM_POSITION     = 0
+IQM_TEXCOORD     = 1
+IQM_NORMAL       = 2
+IQM_TANGENT      = 3
+IQM_BLENDINDEXES = 4
+IQM_BLENDWEIGHTS = 5
+IQM_COLOR        = 6
+IQM_CUSTOM       = 0x10
+
+IQM_BYTE   = 0
+IQM_UBYTE  = 1
+IQM_SHORT  = 2
+IQM_USHORT = 3
+IQM_INT    = 4
+IQM_UINT   = 5
+IQM_HALF   = 6
+IQM_FLOAT  = 7
+IQM_DOUBLE = 8
+
+IQM_HEADER      = struct.Struct('<16s27I')
+IQM_MESH        = struct.Struct('<6I')
+IQM_TRIANGLE    = struct.Struct('<3I')
+IQM_JOINT       = struct.Struct('<Ii10f')
+IQM_POSE        = struct.Struct('<iI20f')
+IQM_ANIMATION   = struct.Struct('<3IfI')
+IQM_VERTEXARRAY = struct.Struct('<5I')
+IQM_BOUNDS      = struct.Struct('<8f')
+
+NO_NEIGHBOR = 0xFFFFFFFF
+
+vertexArrayNames = {
+    IQM_POSITION: 'position',
+    IQM_TEXCOORD: 'texcoord',
+    IQM_NORMAL: 'normal',
+    IQM_TANGENT: 'tangent',
+    IQM_BLENDINDEXES: 'blendindexes',
+    IQM_BLENDWEIGHTS: 'blendweights',
+    IQM_COLOR: 'color'
+}
+
+formatNames = ['byte', 'ubyte', 'short', 'ushort', 'int', 'uint', 'half', 'float', 'double']
+formatChars = ['b', 'B', 'h', 'H', 'i', 'I', 'e', 'f', 'd']
+
+# Header fields after magic
+headerFields = ['version', 'filesize', 'flags', 'numText', 'ofsText', 'numMeshes', 'ofsMeshes',
+    'numVertexArrays', 'numVertices', 'ofsVertexArrays', 'numTriangles', 'ofsTriangles', 'ofsAdjacency',
+    'numJoints', 'ofsJoints', 'numPoses', 'ofsPoses', 'numAnims', 'ofsAnims',
+    'numFrames', 'numFrameChannels', 'ofsFrames', 'ofsBounds', 'numComment', 'ofsComment',
+    'numExtensions', 'ofsExtensions']
+
+DEFAULT_CACHE_SIZES = [16, 32]
+
+class IQMError(Exception):
+    pass
+
+def vertexArrayName(vtype):
+    if vtype >= IQM_CUSTOM:
+        return 'custom%d' % (vtype - IQM_CUSTOM)
+    return vertexArrayNames.get(vtype, 'type%d' % vtype)
+
+def formatName(vformat):
+    return formatNames[vformat] if vformat < len(formatNames) else 'format%d' % vformat
+
+def padded(size):
+    return size + (4 - size % 4) % 4
+
+class IQMVertexArray:
+    def __init__(self, vtype, flags, vformat, size, offset):
+        self.type = vtype
+        self.flags = flags
+        self.format = vformat
+        self.size = size
+        self.offset = offset
+        self.values = []
+
+    def name(self):
+        return vertexArrayName(self.type)
+
+    def structFormat(self, numVertices):
+        return '<%d%s' % (numVertices * self.size, formatChars[self.format])
+
+    def decoded(self, posBounds = None):
+        '''
+        Values as the engine sees them: integer formats are normalized,
+        quantized positions are mapped to the bounds from the comment.
+        Blend indexes and weights are kept as integers.
+        '''
+        if self.type in [IQM_BLENDINDEXES, IQM_BLENDWEIGHTS]:
+            return self.values
+        if self.format == IQM_BYTE:
+            norm = lambda x: max(-1.0, x / 127.0)
+        elif self.format == IQM_UBYTE:
+            norm = lambda x: x / 255.0
+        elif self.format == IQM_SHORT:
+            norm = lambda x: max(-1.0, x / 32767.0)
+        elif self.format == IQM_USHORT:
+            norm = lambda x: x / 65535.0
+        else:
+            norm = float
+        values = [tuple([norm(x) for x in v]) for v in self.values]
+        if self.type == IQM_POSITION and posBounds and self.format not in [IQM_HALF, IQM_FLOAT, IQM_DOUBLE]:
+            bmin, bmax = posBounds
+            values = [tuple([bmin[k] + v[k] * (bmax[k] - bmin[k]) for k in range(3)]) for v in values]
+        return values
+
+    def quantizationError(self, posBounds = None):
+        # Maximum error of each component introduced by the format
+        if self.format in [IQM_FLOAT, IQM_DOUBLE]:
+            return [0.0] * self.size
+        if self.format == IQM_HALF:
+            errors = [0.0] * self.size
+            for v in self.values:
+                for k, x in enumerate(v):
+                    if x != 0.0 and not math.isinf(x):
+                        exponent = max(math.floor(math.log2(abs(x))), -14)
+                        errors[k] = max(errors[k], math.ldexp(1.0, exponent - 11))
+            return errors
+        if self.type in [IQM_BLENDINDEXES, IQM_BLENDWEIGHTS]:
+            return [0.0] * self.size
+        steps = {IQM_BYTE: 127.0, IQM_UBYTE: 255.0, IQM_SHORT: 32767.0, IQM_USHORT: 65535.0}
+        step = 0.5 / steps.get(self.format, 0xFFFFFFFF)
+        if self.type == IQM_POSITION and posBounds:
+            bmin, bmax = posBounds
+            return [step * (bmax[k] - bmin[k]) for k in range(self.size)]
+        return [step] * self.size
+
+# Names keep their offsets in the text section, so that pack() writes them back unchanged
+
+class IQMMesh:
+    def __init__(self, name, material, firstVertex, numVertices, firstTriangle, numTriangles, nameOffset = 0, materialOffset = 0):
+        self.name = name
+        self.material = material
+        self.nameOffset = nameOffset
+        self.materialOffset = materialOffset
+        self.firstVertex = firstVertex
+        self.numVertices = numVertices
+        self.firstTriangle = firstTriangle
+        self.numTriangles = numTriangles
+
+class IQMJoint:
+    def __init__(self, name, parent, translate, rotate, scale, nameOffset = 0):
+        self.name = name
+        self.nameOffset = nameOffset
+        self.parent = parent
+        self.translate = translate
+        self.rotate = rotate
+        self.scale = scale
+
+class IQMPose:
+    def __init__(self, parent, channelMask, channelOffsets, channelScales):
+        self.parent = parent
+        self.channelMask = channelMask
+        self.channelOffsets = channelOffsets
+        self.channelScales = channelScales
+
+class IQMAnimation:
+    def __init__(self, name, firstFrame, numFrames, framerate, flags, nameOffset = 0):
+        self.name = name
+        self.nameOffset = nameOffset
+        self.firstFrame = firstFrame
+        self.numFrames = numFrames
+        self.framerate = framerate
+        self.flags = flags
+
+class IQMFile:
+    '''
+    Parsed IQM model. Every section is kept in a form that pack()
+    turns back into the same bytes, in the order used by iqm_export.py:
+    header, text, meshes, vertex arrays, triangles, adjacency, joints,
+    poses, animations, frames, bounds, comment.
+    '''
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        f = open(filepath, 'rb')
+        self.data = f.read()
+        f.close()
+        self.load()
+
+    def error(self, message):
+        return IQMError('%s: %s' % (self.filepath, message))
+
+    def section(self, offset, size, name):
+        if offset + size > len(self.data):
+            raise self.error('%s section is out of file bounds' % name)
+        return self.data[offset:offset + size]
+
+    def load(self):
+        if len(self.data) < IQM_HEADER.size:
+            raise self.error('file is too small to be an IQM model')
+        fields = IQM_HEADER.unpack_from(self.data, 0)
+        if fields[0] != IQM_MAGIC:
+            raise self.error('not an IQM model')
+        self.header = dict(zip(headerFields, fields[1:]))
+        hdr = self.header
+        if hdr['version'] != IQM_VERSION:
+            raise self.error('unsupported IQM version %d' % hdr['version'])
+
+        self.text = self.section(hdr['ofsText'], hdr['numText'], 'text')
+
+        self.meshes = []
+        for i in range(hdr['numMeshes']):
+            name, material, firstVertex, numVertices, firstTriangle, numTriangles = \
+                IQM_MESH.unpack(self.section(hdr['ofsMeshes'] + i * IQM_MESH.size, IQM_MESH.size, 'meshes'))
+            self.meshes.append(IQMMesh(self.string(name), self.string(material), firstVertex, numVertices, firstTriangle, numTriangles, name, material))
+
+        self.vertexArrays = []
+        for i in range(hdr['numVertexArrays']):
+            va = IQMVertexArray(*IQM_VERTEXARRAY.unpack(self.section(hdr['ofsVertexArrays'] + i * IQM_VERTEXARRAY.size, IQM_VERTEXARRAY.size, 'vertex arrays')))
+            if va.format >= len(formatChars):
+                raise self.error('unknown format %d of %s array' % (va.format, va.name()))
+            fmt = va.structFormat(hdr['numVertices'])
+            flat = struct.unpack(fmt, self.section(va.offset, struct.calcsize(fmt), va.name()))
+            va.values = [flat[j:j + va.size] for j in range(0, len(flat), va.size)]
+            self.vertexArrays.append(va)
+
+        self.triangles = self.readTriangles(hdr['ofsTriangles'], 'triangles')
+        self.adjacency = self.readTriangles(hdr['ofsAdjacency'], 'adjacency')
+
+        self.joints = []
+        for i in range(hdr['numJoints']):
+            j = IQM_JOINT.unpack(self.section(hdr['ofsJoints'] + i * IQM_JOINT.size, IQM_JOINT.size, 'joints'))
+            self.joints.append(IQMJoint(self.string(j[0]), j[1], j[2:5], j[5:9], j[9:12], j[0]))
+
+        self.poses = []
+        for i in range(hdr['numPoses']):
+            p = IQM_POSE.unpack(self.section(hdr['ofsPoses'] + i * IQM_POSE.size, IQM_POSE.size, 'poses'))
+            self.poses.append(IQMPose(p[0], p[1], p[2:12], p[12:22]))
+
+        self.anims = []
+        for i in range(hdr['numAnims']):
+            a = IQM_ANIMATION.unpack(self.section(hdr['ofsAnims'] + i * IQM_ANIMATION.size, IQM_ANIMATION.size, 'animations'))
+            self.anims.append(IQMAnimation(self.string(a[0]), a[1], a[2], a[3], a[4], a[0]))
+
+        numChannels = hdr['numFrames'] * hdr['numFrameChannels']
+        self.frames = []
+        if numChannels and hdr['ofsFrames']:
+            self.frames = list(struct.unpack('<%dH' % numChannels, self.section(hdr['ofsFrames'], numChannels * 2, 'frames')))
+
+        self.bounds = []
+        if hdr['ofsBounds']:
+            for i in range(hdr['numFrames']):
+                self.bounds.append(IQM_BOUNDS.unpack(self.section(hdr['ofsBounds'] + i * IQM_BOUNDS.size, IQM_BOUNDS.size, 'bounds')))
+
+        self.comment = ''
+        if hdr['numComment']:
+            self.comment = self.section(hdr['ofsComment'], hdr['numComment'], 'comment').split(b'\x00')[0].decode('ascii', 'replace')
+
+    def readTriangles(self, offset, name):
+        if not offset:
+            return []
+        data = self.section(offset, self.header['numTriangles'] * IQM_TRIANGLE.size, name)
+        return [IQM_TRIANGLE.unpack_from(data, i * IQM_TRIANGLE.size) for i in range(self.header['numTriangles'])]
+
+    def string(self, offset):
+        if offset >= len(self.text):
+            raise self.error('text offset %d is out of bounds' % offset)
+        end = self.text.find(b'\x00', offset)
+        if end < 0:
+            raise self.error('string at %d is not terminated' % offset)
+        return self.text[offset:end].decode('utf-8', 'replace')
+
+    def vertexArray(self, vtype):
+        for va in self.vertexArrays:
+            if va.type == vtype:
+                return va
+        return None
+
+    def positionBounds(self):
+        # Bounds of quantized positions from the "positions" comment line
+        for line in self.comment.splitlines():
+            words = line.split()
+            if len(words) == 7 and words[0] == 'positions':
+                values = [float(w) for w in words[1:]]
+                return (values[0:3], values[3:6])
+        return None
+
+    def positions(self):
+        va = self.vertexArray(IQM_POSITION)
+        return va.decoded(self.positionBounds()) if va else []
+
+    def sections(self):
+        # (name, offset, size) of every non-empty section in file order
+        hdr = self.header
+        vertexDataSize = sum([padded(struct.calcsize(va.structFormat(hdr['numVertices']))) for va in self.vertexArrays])
+        sections = [
+            ('header', 0, IQM_HEADER.size),
+            ('text', hdr['ofsText'], hdr['numText']),
+            ('meshes', hdr['ofsMeshes'], hdr['numMeshes'] * IQM_MESH.size),
+            ('vertex arrays', hdr['ofsVertexArrays'], hdr['numVertexArrays'] * IQM_VERTEXARRAY.size + vertexDataSize),
+            ('triangles', hdr['ofsTriangles'], hdr['numTriangles'] * IQM_TRIANGLE.size),
+            ('adjacency', hdr['ofsAdjacency'], hdr['numTriangles'] * IQM_TRIANGLE.size if hdr['ofsAdjacency'] else 0),
+            ('joints', hdr['ofsJoints'], hdr['numJoints'] * IQM_JOINT.size),
+            ('poses', hdr['ofsPoses'], hdr['numPoses'] * IQM_POSE.size),
+            ('animations', hdr['ofsAnims'], hdr['numAnims'] * IQM_ANIMATION.size),
+            ('frames', hdr['ofsFrames'], padded(len(self.frames) * 2)),
+            ('bounds', hdr['ofsBounds'], len(self.bounds) * IQM_BOUNDS.size),
+            ('comment', hdr['ofsComment'], hdr['numComment'])]
+        return [(name, offset, size) for (name, offset, size) in sections if size > 0]
+
+    def pack(self):
+        '''
+        Writes the parsed model back with the layout of IQMFile.export in iqm_export.py.
+        For a file written by the exporter the result is identical to the original.
+        '''
+        hdr = dict(self.header)
+        body = bytearray()
+
+        def place(data):
+            offset = IQM_HEADER.size + len(body)
+            body.extend(data)
+            return offset
+
+        hdr['ofsText'] = place(self.text) if self.text else 0
+
+        meshData = b''.join([IQM_MESH.pack(m.nameOffset, m.materialOffset, m.firstVertex, m.numVertices, m.firstTriangle, m.numTriangles) for m in self.meshes])
+        hdr['ofsMeshes'] = place(meshData) if meshData else 0
+
+        if self.vertexArrays and hdr['numVertices'] > 0:
+            hdr['ofsVertexArrays'] = IQM_HEADER.size + len(body)
+            offset = hdr['ofsVertexArrays'] + len(self.vertexArrays) * IQM_VERTEXARRAY.size
+            arrays = []
+            for va in self.vertexArrays:
+                fmt = va.structFormat(hdr['numVertices'])
+                data = struct.pack(fmt, *[x for v in va.values for x in v])
+                data += b'\x00' * (padded(len(data)) - len(data))
+                body.extend(IQM_VERTEXARRAY.pack(va.type, va.flags, va.format, va.size, offset))
+                arrays.append(data)
+                offset += len(data)
+            for data in arrays:
+                body.extend(data)
+        else:
+            hdr['ofsVertexArrays'] = 0
+
+        if self.triangles:
+            hdr['ofsTriangles'] = place(b''.join([IQM_TRIANGLE.pack(*t) for t in self.triangles]))
+            hdr['ofsAdjacency'] = place(b''.join([IQM_TRIANGLE.pack(*t) for t in self.adjacency])) if self.adjacency else 0
+        else:
+            hdr['ofsTriangles'] = hdr['ofsAdjacency'] = 0
+
+        jointData = b''.join([IQM_JOINT.pack(j.nameOffset, j.parent, *(tuple(j.translate) + tuple(j.rotate) + tuple(j.scale))) for j in self.joints])
+        hdr['ofsJoints'] = place(jointData) if jointData else 0
+
+        poseData = b''.join([IQM_POSE.pack(p.parent, p.channelMask, *(tuple(p.channelOffsets) + tuple(p.channelScales))) for p in self.poses])
+        hdr['ofsPoses'] = place(poseData) if poseData else 0
+
+        animData = b''.join([IQM_ANIMATION.pack(a.nameOffset, a.firstFrame, a.numFrames, a.framerate, a.flags) for a in self.anims])
+        hdr['ofsAnims'] = place(animData) if animData else 0
+
+        if self.frames:
+            data = struct.pack('<%dH' % len(self.frames), *self.frames)
+            hdr['ofsFrames'] = place(data + b'\x00' * (padded(len(data)) - len(data)))
+        else:
+            hdr['ofsFrames'] = 0
+
+        hdr['ofsBounds'] = place(b''.join([IQM_BOUNDS.pack(*b) for b in self.bounds])) if self.bounds else 0
+
+        if self.comment:
+            data = bytes(self.comment, encoding = 'ascii') + b'\x00'
+            data += b'\x00' * (padded(len(data)) - len(data))
+            hdr['numComment'] = len(data)
+            hdr['ofsComment'] = place(data)
+        else:
+            hdr['numComment'] = hdr['ofsComment'] = 0
+
+        hdr['filesize'] = IQM_HEADER.size + len(body)
+        return IQM_HEADER.pack(IQM_MAGIC, *[hdr[name] for name in headerFields]) + bytes(body)
+
+    def meshTriangles(self, mesh):
+        return self.triangles[mesh.firstTriangle:mesh.firstTriangle + mesh.numTriangles]
+
+    def verify(self):
+        # Returns a list of problems, empty if the file is consistent
+        problems = []
+        hdr = self.header
+        if hdr['filesize'] != len(self.data):
+            problems.append('header file size %d, actual size %d' % (hdr['filesize'], len(self.data)))
+
+        try:
+            packed = self.pack()
+        except (IQMError, struct.error) as e:
+            packed = None
+            problems.append('can\'t write the model back: %s' % e)
+        if packed is not None and packed != self.data:
+            if len(packed) != len(self.data):
+                problems.append('round trip size %d, original size %d' % (len(packed), len(self.data)))
+            pos = next((i for i in range(min(len(packed), len(self.data))) if packed[i] != self.data[i]), None)
+            if pos is not None:
+                names = [name for (name, offset, size) in self.sections() if offset <= pos < offset + size]
+                problems.append('round trip differs at offset %d (%s)' % (pos, names[0] if names else 'padding'))
+
+        nextVertex = 0
+        nextTriangle = 0
+        for mesh in self.meshes:
+            if mesh.firstVertex != nextVertex or mesh.firstTriangle != nextTriangle:
+                problems.append('%s: mesh ranges are not contiguous' % mesh.name)
+            nextVertex = mesh.firstVertex + mesh.numVertices
+            nextTriangle = mesh.firstTriangle + mesh.numTriangles
+            for t in self.meshTriangles(mesh):
+                if any([i < mesh.firstVertex or i >= nextVertex for i in t]):
+                    problems.append('%s: triangle %s uses vertices of another mesh' % (mesh.name, t))
+                    break
+        if self.meshes and (nextVertex != hdr['numVertices'] or nextTriangle != hdr['numTriangles']):
+            problems.append('meshes cover %d vertices and %d triangles of %d and %d' % (nextVertex, nextTriangle, hdr['numVertices'], hdr['numTriangles']))
+
+        for i, (t, n) in enumerate(zip(self.triangles, self.adjacency)):
+            for e in range(3):
+                if n[e] == NO_NEIGHBOR:
+                    continue
+                if n[e] >= len(self.triangles):
+                    problems.append('triangle %d: neighbor %d is out of range' % (i, n[e]))
+                elif i not in self.adjacency[n[e]]:
+                    problems.append('triangle %d: neighbor %d doesn\'t point back' % (i, n[e]))
+
+        weights = self.vertexArray(IQM_BLENDWEIGHTS)
+        if weights:
+            bad = len([w for w in weights.values if sum(w) != 255])
+            if bad:
+                problems.append('%d vertices have blend weights that don\'t sum to 255' % bad)
+        indexes = self.vertexArray(IQM_BLENDINDEXES)
+        if indexes and any([i >= len(self.joints) for v in indexes.values for i in v]):
+            problems.append('blend indexes are out of the skeleton')
+
+        for i, joint in enumerate(self.joints):
+            if joint.parent >= i:
+                problems.append('%s: parent %d is not before the joint' % (joint.name, joint.parent))
+        if self.anims and len(self.poses) != len(self.joints):
+            problems.append('%d poses for %d joints' % (len(self.poses), len(self.joints)))
+        numChannels = sum([bin(p.channelMask).count('1') for p in self.poses])
+        if self.poses and numChannels != hdr['numFrameChannels']:
+            problems.append('poses have %d channels, header has %d' % (numChannels, hdr['numFrameChannels']))
+        for anim in self.anims:
+            if anim.firstFrame + anim.numFrames > hdr['numFrames']:
+                problems.append('%s: frames are out of range' % anim.name)
+        for i, b in enumerate(self.bounds):
+            if any([b[k] > b[k + 3] for k in range(3)]):
+                problems.append('frame %d: bounding box is inverted' % i)
+        return problems
+
+    # Skeletal animation
+
+    def jointMatrices(self):
+        # Inverse bind pose matrices
+        base = []
+        for joint in self.joints:
+            m = composeMatrix(joint.translate, joint.rotate, joint.scale)
+            if joint.parent >= 0:
+                m = mulMatrix(base[joint.parent], m)
+            base.append(m)
+        return [invertMatrix(m) for m in base]
+
+    def frameMatrices(self, frame, invBase):
+        # Skinning matrices of a frame
+        hdr = self.header
+        pos = frame * hdr['numFrameChannels']
+        result = []
+        globals = []
+        for i, pose in enumerate(self.poses):
+            channels = list(pose.channelOffsets)
+            for c in range(10):
+                if pose.channelMask & (1 << c):
+                    channels[c] += self.frames[pos] * pose.channelScales[c]
+                    pos += 1
+            m = composeMatrix(channels[0:3], channels[3:7], channels[7:10])
+            if pose.parent >= 0:
+                m = mulMatrix(globals[pose.parent], m)
+            globals.append(m)
+            result.append(mulMatrix(m, invBase[i]))
+        return result
+
+    def framePositions(self, frame, invBase, positions):
+        matrices = self.frameMatrices(frame, invBase)
+        indexes = self.vertexArray(IQM_BLENDINDEXES).values
+        weights = self.vertexArray(IQM_BLENDWEIGHTS).values
+        result = []
+        for p, vi, vw in zip(positions, indexes, weights):
+            x = y = z = 0.0
+            for i, w in zip(vi, vw):
+                if w:
+                    tx, ty, tz = transformPoint(matrices[i], p)
+                    x += tx * w / 255.0
+                    y += ty * w / 255.0
+                    z += tz * w / 255.0
+            result.append((x, y, z))
+        return result
+
+    def boundsTightness(self):
+        '''
+        Compares the stored bounds of every frame with the bounds of skinned positions.
+        Returns (animation, max volume ratio, max radius ratio, frames that don't contain the model).
+        '''
+        if not self.bounds or not self.poses or not self.vertexArray(IQM_BLENDWEIGHTS):
+            return []
+        invBase = self.jointMatrices()
+        positions = self.positions()
+        result = []
+        for anim in self.anims:
+            maxVolumeRatio = 1.0
+            maxRadiusRatio = 1.0
+            notContained = 0
+            for frame in range(anim.firstFrame, anim.firstFrame + anim.numFrames):
+                b = self.bounds[frame]
+                actual = boundsOf(self.framePositions(frame, invBase, positions))
+                eps = 1.0e-4 * max(1.0, actual[7])
+                if any([actual[k] < b[k] - eps or actual[k + 3] > b[k + 3] + eps for k in range(3)]) or actual[7] > b[7] + eps:
+                    notContained += 1
+                actualVolume = volume(actual)
+                if actualVolume > 0.0:
+                    maxVolumeRatio = max(maxVolumeRatio, volume(b) / actualVolume)
+                if actual[7] > 0.0:
+                    maxRadiusRatio = max(maxRadiusRatio, b[7] / actual[7])
+            result.append((anim.name, maxVolumeRatio, maxRadiusRatio, notContained))
+        return result
+
+def composeMatrix(t, q, s):
+    # 3x4 row-major matrix of translate * rotate * scale
+    x, y, z, w = q
+    n = math.sqrt(x * x + y * y + z * z + w * w)
+    if n > 0.0:
+        x, y, z, w = x / n, y / n, z / n, w / n
+    r = [1.0 - 2.0 * (y * y + z * z), 2.0 * (x * y - z * w), 2.0 * (x * z + y * w),
+         2.0 * (x * y + z * w), 1.0 - 2.0 * (x * x + z * z), 2.0 * (y * z - x * w),
+         2.0 * (x * z - y * w), 2.0 * (y * z + x * w), 1.0 - 2.0 * (x * x + y * y)]
+    return [r[0] * s[0], r[1] * s[1], r[2] * s[2], t[0],
+            r[3] * s[0], r[4] * s[1], r[5] * s[2], t[1],
+            r[6] * s[0], r[7] * s[1], r[8] * s[2], t[2]]
+
+def mulMatrix(a, b):
+    m = []
+    for i in range(3):
+        for j in range(4):
+            v = a[i * 4 + 0] * b[j] + a[i * 4 + 1] * b[4 + j] + a[i * 4 + 2] * b[8 + j]
+            if j == 3:
+                v += a[i * 4 + 3]
+            m.append(v)
+    return m
+
+def invertMatrix(m):
+    a, b, c, d, e, f, g, h, i = m[0], m[1], m[2], m[4], m[5], m[6], m[8], m[9], m[10]
+    det = a * (e * i - f * h) - b * (d * i - f * g) + c * (d * h - e * g)
+    if det == 0.0:
+        raise IQMError('joint matrix is singular')
+    r = [(e * i - f * h) / det, (c * h - b * i) / det, (b * f - c * e) / det,
+         (f * g - d * i) / det, (a * i - c * g) / det, (c * d - a * f) / det,
+         (d * h - e * g) / det, (b * g - a * h) / det, (a * e - b * d) / det]
+    t = [m[3], m[7], m[11]]
+    return [r[0], r[1], r[2], -(r[0] * t[0] + r[1] * t[1] + r[2] * t[2]),
+            r[3], r[4], r[5], -(r[3] * t[0] + r[4] * t[1] + r[5] * t[2]),
+            r[6], r[7], r[8], -(r[6] * t[0] + r[7] * t[1] + r[8] * t[2])]
+
+def transformPoint(m, p):
+    return (m[0] * p[0] + m[1] * p[1] + m[2] * p[2] + m[3],
+            m[4] * p[0] + m[5] * p[1] + m[6] * p[2] + m[7],
+            m[8] * p[0] + m[9] * p[1] + m[10] * p[2] + m[11])
+
+def boundsOf(positions):
+    # Same layout as IQM_BOUNDS: min, max, xy radius, radius
+    if not positions:
+        return (0.0,) * 8
+    bmin = [min([p[k] for p in positions]) for k in range(3)]
+    bmax = [max([p[k] for p in positions]) for k in range(3)]
+    xyRadius = math.sqrt(max([p[0] * p[0] + p[1] * p[1] for p in positions]))
+    radius = math.sqrt(max([p[0] * p[0] + p[1] * p[1] + p[2] * p[2] for p in positions]))
+    return tuple(bmin + bmax + [xyRadius, radius])
+
+def volume(b):
+    return (b[3] - b[0]) * (b[4] - b[1]) * (b[5] - b[2])
+
+# Vertex cache simulation
+
+def cacheMisses(triangles, cacheSize, fifo = True):
+    # Number of vertex shader invocations with a FIFO or LRU post-transform cache
+    cache = []
+    misses = 0
+    for t in triangles:
+        for v in t:
+            if v in cache:
+                if not fifo:
+                    cache.remove(v)
+                    cache.insert(0, v)
+                continue
+            misses += 1
+            cache.insert(0, v)
+            del cache[cacheSize:]
+    return misses
+
+def cacheStats(triangles, cacheSize, fifo = True):
+    # ACMR (misses per triangle) and ATVR (misses per referenced vertex)
+    if not triangles:
+        return 0.0, 0.0
+    misses = cacheMisses(triangles, cacheSize, fifo)
+    numVertices = len(set([v for t in triangles for v in t]))
+    return float(misses) / len(triangles), float(misses) / numVertices
+
+def cacheColumns(cacheSizes):
+    return [('fifo', size, True) for size in cacheSizes] + [('lru', size, False) for size in cacheSizes]
+
+def printCacheStats(iqm, cacheSizes):
+    columns = cacheColumns(cacheSizes)
+    print('ACMR/ATVR by vertex cache:')
+    print('%-32s %8s %8s %s' % ('mesh', 'verts', 'tris', ' '.join(['%13s' % ('%s%d' % (policy, size)) for (policy, size, fifo) in columns])))
+    for mesh in iqm.meshes + [None]:
+        if mesh is None:
+            if len(iqm.meshes) < 2:
+                break
+            name, triangles, numVertices = '(all)', iqm.triangles, iqm.header['numVertices']
+        else:
+            name, triangles, numVertices = mesh.name, iqm.meshTriangles(mesh), mesh.numVertices
+        stats = [cacheStats(triangles, size, fifo) for (policy, size, fifo) in columns]
+        print('%-32s %8d %8d %s' % (name, numVertices, len(triangles), ' '.join(['%6.3f/%6.3f' % s for s in stats])))
+
+def printInfo(iqm, cacheSizes, useBounds = True):
+    hdr = iqm.header
+    print('%s: %d bytes' % (iqm.filepath, len(iqm.data)))
+    print('%d meshes, %d vertices, %d triangles, %d joints, %d animations, %d frames' %
+        (len(iqm.meshes), hdr['numVertices'], hdr['numTriangles'], len(iqm.joints), len(iqm.anims), hdr['numFrames']))
+
+    print('')
+    print('%10s %10s  %s' % ('offset', 'size', 'section'))
+    for (name, offset, size) in iqm.sections():
+        print('%10d %10d  %s' % (offset, size, name))
+
+    print('')
+    posBounds = iqm.positionBounds()
+    print('%-14s %-7s %10s  %s' % ('array', 'format', 'size', 'max quantization error per component'))
+    for va in iqm.vertexArrays:
+        size = padded(struct.calcsize(va.structFormat(hdr['numVertices'])))
+        errors = va.quantizationError(posBounds)
+        print('%-14s %-7s %10d  %s' % (va.name(), '%s%d' % (formatName(va.format), va.size), size, ' '.join(['%.3g' % e for e in errors])))
+
+    print('')
+    printCacheStats(iqm, cacheSizes)
+
+    if useBounds:
+        positions = iqm.positions()
+        if positions:
+            b = boundsOf(positions)
+            print('')
+            print('Bind pose bounds: (%.4g %.4g %.4g) - (%.4g %.4g %.4g), radius %.4g' % (b[0:6] + (b[7],)))
+        if posBounds:
+            # Positions are quantized over these bounds, larger bounds mean larger steps
+            print('Quantization bounds: (%.4g %.4g %.4g) - (%.4g %.4g %.4g)' % tuple(posBounds[0] + posBounds[1]))
+        tightness = iqm.boundsTightness()
+        if tightness:
+            print('%-32s %12s %12s %12s' % ('animation', 'volume ratio', 'radius ratio', 'not covered'))
+            for (name, volumeRatio, radiusRatio, notContained) in tightness:
+                print('%-32s %12.3f %12.3f %12d' % (name, volumeRatio, radiusRatio, notContained))
+
+    if iqm.comment:
+        print('')
+        print('Comment:')
+        for line in iqm.comment.splitlines():
+            print('  ' + line)
+
+def channelDifference(a, b):
+    # Maximum and RMS difference of each component
+    size = len(a[0]) if a else 0
+    maxDiff = [0.0] * size
+    sumSq = [0.0] * size
+    for va, vb in zip(a, b):
+        for k in range(size):
+            d = abs(va[k] - vb[k])
+            maxDiff[k] = max(maxDiff[k], d)
+            sumSq[k] += d * d
+    rms = [math.sqrt(s / len(a)) if a else 0.0 for s in sumSq]
+    return maxDiff, rms
+
+def printDiff(a, b, cacheSizes):
+    def row(name, x, y, fmt = '%d'):
+        print('%-24s %14s %14s %14s' % (name, fmt % x, fmt % y, (fmt % (y - x)) if x != y else ''))
+
+    print('%-24s %14s %14s %14s' % ('', os.path.basename(a.filepath)[-14:], os.path.basename(b.filepath)[-14:], 'change'))
+    row('file size', len(a.data), len(b.data))
+    for field in ['numMeshes', 'numVertices', 'numTriangles', 'numJoints', 'numAnims', 'numFrames', 'numFrameChannels']:
+        row(field, a.header[field], b.header[field])
+
+    print('')
+    sectionsA = dict([(name, size) for (name, offset, size) in a.sections()])
+    sectionsB = dict([(name, size) for (name, offset, size) in b.sections()])
+    for (name, offset, size) in a.sections() + [s for s in b.sections() if s[0] not in sectionsA]:
+        row(name, sectionsA.get(name, 0), sectionsB.get(name, 0))
+
+    print('')
+    meshesB = dict([(mesh.name, mesh) for mesh in b.meshes])
+    columns = cacheColumns(cacheSizes)
+    for mesh in a.meshes:
+        other = meshesB.get(mesh.name)
+        if other is None:
+            print('%s: only in %s' % (mesh.name, a.filepath))
+            continue
+        row(mesh.name + ' verts', mesh.numVertices, other.numVertices)
+        row(mesh.name + ' tris', mesh.numTriangles, other.numTriangles)
+        for (policy, size, fifo) in columns:
+            row('%s %s%d ACMR' % (mesh.name, policy, size), cacheStats(a.meshTriangles(mesh), size, fifo)[0], cacheStats(b.meshTriangles(other), size, fifo)[0], '%.3f')
+    for mesh in b.meshes:
+        if mesh.name not in [m.name for m in a.meshes]:
+            print('%s: only in %s' % (mesh.name, b.filepath))
+
+    print('')
+    if a.header['numVertices'] != b.header['numVertices']:
+        print('Vertex counts differ, vertex data is not compared')
+    else:
+        boundsA, boundsB = a.positionBounds(), b.positionBounds()
+        print('%-14s %-9s %-9s  %s' % ('array', 'format', 'format', 'max / RMS difference per component'))
+        for va in a.vertexArrays:
+            vb = b.vertexArray(va.type)
+            if vb is None:
+                print('%-14s only in %s' % (va.name(), a.filepath))
+                continue
+            maxDiff, rms = channelDifference(va.decoded(boundsA), vb.decoded(boundsB))
+            print('%-14s %-9s %-9s  %s' % (va.name(), '%s%d' % (formatName(va.format), va.size), '%s%d' % (formatName(vb.format), vb.size),
+                ' '.join(['%.3g/%.3g' % (m, r) for (m, r) in zip(maxDiff, rms)])))
+        if a.triangles != b.triangles:
+            print('Triangles differ')
+
+    if [j.name for j in a.joints] != [j.name for j in b.joints]:
+        print('Skeletons differ')
+    animsB = dict([(anim.name, anim) for anim in b.anims])
+    for anim in a.anims:
+        other = animsB.get(anim.name)
+        if other is None:
+            print('%s: only in %s' % (anim.name, a.filepath))
+        elif anim.numFrames != other.numFrames or anim.framerate != other.framerate:
+            print('%s: %d frames at %g fps, %d frames at %g fps' % (anim.name, anim.numFrames, anim.framerate, other.numFrames, other.framerate))
+
+def parseCacheSizes(s):
+    try:
+        sizes = [int(x) for x in s.split(',') if x.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected a comma separated list of cache sizes')
+    if not sizes or min(sizes) < 3:
+        raise argparse.ArgumentTypeError('cache sizes should be at least 3')
+    return sizes
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Inspect, verify and compare IQM models (*.iqm)')
+    commands = parser.add_subparsers(dest = 'command')
+    commands.required = True
+
+    p = commands.add_parser('info', help = 'show sections, vertex formats, cache efficiency and bounds')
+    p.add_argument('model')
+    p.add_argument('--cache', type = parseCacheSizes, default = DEFAULT_CACHE_SIZES, help = 'vertex cache sizes (default: 16,32)')
+    p.add_argument('--no-bounds', action = 'store_true', help = 'don\'t skin animation frames to check bounds')
+
+    p = commands.add_parser('verify', help = 'check consistency and round trip the file')
+    p.add_argument('model')
+
+    p = commands.add_parser('diff', help = 'compare two models')
+    p.add_argument('model')
+    p.add_argument('other')
+    p.add_argument('--cache', type = parseCacheSizes, default = DEFAULT_CACHE_SIZES, help = 'vertex cache sizes (default: 16,32)')
+
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'info':
+            printInfo(IQMFile(args.model), args.cache, not args.no_bounds)
+        elif args.command == 'verify':
+            problems = IQMFile(args.model).verify()
+            for problem in problems:
+                print(problem)
+            if problems:
+                return 1
+            print('%s: OK' % args.model)
+        elif args.command == 'diff':
+            printDiff(IQMFile(args.model), IQMFile(args.other), args.cache)
+    except IQMError as e:
+        print(e, file = sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())